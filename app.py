@@ -1,17 +1,220 @@
-from flask import Flask, request, Response
-from geobot.tileget import Tileget
-from geobot.tilerender import draw_image
+from flask import Flask, request, Response, jsonify, g
+from geobot.tileget import get_tileget
+from geobot.tilerender import render_image
+from geobot.renderplan import plan_render
+from geobot.cluster import cluster_geojson
+from geobot.tilesynth import TileSynth, SynthPolicy
 from geobot.geo import Bbox, LonLat
-from geobot.overpass import SimpleQuery
+from geobot.poicache import PoiCache
+from geobot.osmindex import OsmIndex, LocalQuery
+from geobot.cache import DiskCache, PixelCache, shm_path
+from geobot.rendercache import RenderCache, render_key, quantize
+from geobot.singleflight import SingleFlight
+from geobot.encoding import Encoding, EncodingError, negotiate
+from geobot import metrics
+from geobot.metrics import stage, CACHE_LOOKUPS, REQUEST_SECONDS
 import os
+import time
 import geojson
-from shutil import rmtree
 app = Flask(__name__)
 
+# Identical fetches in flight (tiles, Overpass queries) are done only once, also across the workers
+flight = SingleFlight(os.getenv('GEOBOT_LOCKS', '/tmp/geobot/locks'))
+# Tile cache, shared by all the workers
+tile_cache = DiskCache(
+    os.getenv('GEOBOT_TILE_CACHE', '/tmp/geobot/tiles'),
+    max_bytes=int(os.getenv('GEOBOT_TILE_CACHE_MB', 256)) * 2**20,
+    ttl=int(os.getenv('GEOBOT_TILE_CACHE_TTL', 7 * 24 * 3600))
+)
+# Decoded tiles, in shared memory
+pixel_cache = PixelCache(
+    os.getenv('GEOBOT_PIXEL_CACHE', shm_path('geobot/pixels')),
+    max_bytes=int(os.getenv('GEOBOT_PIXEL_CACHE_MB', 128)) * 2**20
+)
+# Rendered images: in memory (per worker) and on disk (shared)
+render_cache = RenderCache(
+    DiskCache(
+        os.getenv('GEOBOT_RENDER_CACHE', '/tmp/geobot/renders'),
+        max_bytes=int(os.getenv('GEOBOT_RENDER_CACHE_MB', 128)) * 2**20,
+        ttl=int(os.getenv('GEOBOT_RENDER_CACHE_TTL', 24 * 3600))
+    ),
+    max_items=int(os.getenv('GEOBOT_RENDER_CACHE_ITEMS', 64))
+)
+# Points of Interest, cached by tile
+poi_cache = PoiCache(
+    DiskCache(
+        os.getenv('GEOBOT_POI_CACHE', '/tmp/geobot/poi'),
+        max_bytes=int(os.getenv('GEOBOT_POI_CACHE_MB', 64)) * 2**20,
+        ttl=int(os.getenv('GEOBOT_POI_CACHE_TTL', 24 * 3600))
+    ),
+    zoom=int(os.getenv('GEOBOT_POI_ZOOM', 14)),
+    url=os.getenv('OVERPASS_URL'),
+    flight=flight
+)
+# Offline index of an OSM extract: if given, it is used instead of Overpass
+osm_index = OsmIndex(os.getenv('GEOBOT_OSM_INDEX')) if os.getenv('GEOBOT_OSM_INDEX') else None
+# Seconds allowed to download the tiles of an image; late tiles are replaced
+DEADLINE = float(os.getenv('GEOBOT_DEADLINE', 8))
+# When tiles may be synthesized out of the cached tiles of the neighbouring zooms (never, fallback, prefer)
+synth_policy = SynthPolicy(mode=os.getenv('GEOBOT_SYNTH', 'fallback'))
+# Decimal digits the coordinates are rounded to (5 digits are about 1 meter)
+PRECISION = int(os.getenv('GEOBOT_PRECISION', 5))
+# Seconds the clients may keep an image
+MAX_AGE = int(os.getenv('GEOBOT_MAX_AGE', 3600))
+# Pixels of the cells the markers of the Points of Interest are clustered by (0: no clustering)
+CLUSTER_CELL = int(os.getenv('GEOBOT_CLUSTER_PX', 32))
+# Directory where every worker writes its metrics (every second), summed up by /metrics
+METRICS_DIR = os.getenv('GEOBOT_METRICS', '/tmp/geobot/metrics')
+
+@app.before_request
+def start_timings():
+    g.start = time.perf_counter()
+    g.timings = metrics.start_timings()
+    metrics.REGISTRY.autoflush(METRICS_DIR)
+
+@app.after_request
+def add_timings(response):
+    ''' Adds the durations of the stages of the request in the Server-Timing header, and records the metrics '''
+    duration = time.perf_counter() - g.start
+    REQUEST_SECONDS.observe(duration, endpoint=request.endpoint, status=response.status_code)
+    response.headers['Server-Timing'] = metrics.server_timing(g.timings + [("total", duration)])
+    return response
+
+def cache_headers(key):
+    ''' Gets the HTTP caching headers of a render '''
+    return {
+        # Weak: the key identifies the request, not the bytes (a later render may differ, e.g. with new tiles)
+        'ETag': f'W/"{key}"',
+        'Cache-Control': f"public, max-age={MAX_AGE}",
+        'Vary': "Accept"
+    }
+
+def int_arg(name):
+    ''' Gets an integer argument of the request, or None '''
+    value = request.args.get(name)
+    if value is None:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise EncodingError(f"{name} must be an integer")
+
+def output_encoding():
+    '''
+    Gets the Encoding of the image requested
+
+    Arguments: format (png, jpeg, webp; if missing, negotiated by the Accept header, default png),
+    quality (jpeg and webp, 1-100), compress (png, 0-9), colors (png palette, 2-256)
+    '''
+    fmt = request.args.get('format') or negotiate(request.headers.get('Accept'))
+    return Encoding(fmt, quality=int_arg('quality'), compress_level=int_arg('compress'), colors=int_arg('colors'))
+
+@app.errorhandler(EncodingError)
+def bad_encoding(e):
+    return Response(str(e), status=400)
+
+def cached_response(key, encoding: Encoding):
+    '''
+    Builds the response of a render out of the caches, without rendering
+
+    Returns 304 if the client already has the image (If-None-Match), the cached image if any, otherwise None
+    '''
+    if request.if_none_match.contains_weak(key):
+        CACHE_LOOKUPS.inc(cache="render", result="not_modified")
+        return Response(status=304, headers=cache_headers(key))
+    data = render_cache.get(key)
+    CACHE_LOOKUPS.inc(cache="render", result="hit" if data is not None else "miss")
+    if data is None:
+        return None
+    headers = cache_headers(key)
+    headers['Content-Type'] = encoding.mimetype
+    return Response(data, headers=headers)
+
+def image_response(image, encoding: Encoding, key=None, complete=True):
+    '''
+    Builds the response out of a rendered image (Dtile)
+    
+    If the key of the render is given, the image is cached,
+    unless it is degraded (some tiles were replaced, see X-Degraded-Tiles) or not complete (e.g., the POI failed)
+    '''
+    if image is None:
+        return Response("Error rendering the image", status=500)
+    with stage("encode"):
+        data = image.to_bytes(encoding=encoding)
+    headers = {
+        'Content-Type': encoding.mimetype,
+        'X-Degraded-Tiles': str(image.degraded)
+    }
+    if image.degraded > 0 or not complete:
+        headers['Cache-Control'] = "no-store"
+        headers['Vary'] = "Accept"
+    elif key is not None:
+        render_cache.put(key, data)
+        headers.update(cache_headers(key))
+    return Response(data, headers=headers)
+
+def query_poi(bbox, poi):
+    ''' Gets the Points of Interest inside the bbox, from the offline index if any, otherwise from Overpass '''
+    if osm_index is not None:
+        q = LocalQuery(bbox, osm_index)
+        for p in poi:
+            q.add_poi(p)
+        return q.execute()
+    return poi_cache.query(bbox, poi)
+
+def poi_geojson(bbox, content, cropped):
+    '''
+    Gets the requested Points of Interest inside the bbox as markers, as (GeoJSON dump or None, complete)
+
+    complete is False if they could not be retrieved (e.g., Overpass failed): the image
+    is then drawn without them, and must not be cached (see image_response).
+    The markers colliding at the scale of the image are clustered (see cluster_geojson), unless CLUSTER_CELL is 0.
+    '''
+    try:
+        poi = content['poi']
+    except Exception:
+        return None, True
+    try:
+        with stage("poi"):
+            res = query_poi(bbox, poi)
+        geo_data = res.to_geojson(node_props={"marker": True})
+        if CLUSTER_CELL > 0:
+            with stage("cluster"):
+                plan = plan_render(bbox, crop_bbox=cropped)
+                geo_data = cluster_geojson(geo_data, plan.region, plan.size, CLUSTER_CELL)
+        return geojson.dumps(geo_data), True
+    except Exception as e:
+        print(f"Points of Interest not available: {e}")
+        return None, False
+
+def poi_list(content):
+    ''' Gets the list of the requested Points of Interest, if any '''
+    try:
+        return [str(p) for p in content['poi']]
+    except Exception:
+        return None
+
 @app.route('/')
 def root_response():
     return 'Hello from DO App Platform!'
 
+@app.route('/api/stats')
+def show_stats():
+    ''' Shows the counters of the caches (of the worker answering) '''
+    return jsonify({
+        'tiles': tile_cache.stats(),
+        'pixels': pixel_cache.stats(),
+        'renders': render_cache.stats(),
+        'poi': poi_cache.disk.stats()
+    })
+
+@app.route('/metrics')
+def show_metrics():
+    ''' Shows the metrics of all the workers, in the Prometheus text format '''
+    metrics.REGISTRY.write(METRICS_DIR)
+    text = metrics.to_prometheus(metrics.collect(METRICS_DIR))
+    return Response(text, headers={'Content-Type': "text/plain; version=0.0.4"})
+
 @app.route('/api/bbox/<w>/<n>/<e>/<s>', methods=['GET', 'POST'])
 def show_bbox(w, n, e, s):
     '''
@@ -19,74 +222,62 @@ def show_bbox(w, n, e, s):
     
     Optionally, some GeoJSON to be rendered can be passed as argument
     '''
-    bbox = Bbox(float(w), float(n), float(e), float(s))
+    coords = quantize((float(w), float(n), float(e), float(s)), PRECISION)
+    bbox = Bbox(*coords)
     try:
         content = request.get_json(force=True)
-        content = geojson.dumps(content)
     except Exception:
         content = None
 
-    # Build a Tile Getter
-    getter = Tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'))
-    
     # Optional parameters
     cropped = request.args.get('cropped', False)
     cropped = True if not cropped is False else False
 
+    # Check the caches
+    encoding = output_encoding()
+    key = render_key("bbox", coords, cropped=cropped, geo_json=content, img_type=encoding.format, encoding=encoding.params())
+    cached = cached_response(key, encoding)
+    if cached is not None:
+        return cached
+    content = geojson.dumps(content) if content is not None else None
+
+    # Get the Tile Getter (one per worker, keeping its connections alive)
+    getter = get_tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'), cache=tile_cache, flight=flight)
+    synth = TileSynth(getter, synth_policy, pixel_cache)
+
     # Build image
-    out = draw_image(bbox, getter, watermark="© Mapbox", geo_json=content, crop_bbox=cropped)
+    image = render_image(bbox, getter, watermark="© Mapbox", geo_json=content, crop_bbox=cropped, pixel_cache=pixel_cache, deadline=DEADLINE, synth=synth)
 
-    path = out.path
-    out_dir = out.dir
-    
-    with open(path, 'rb') as f:
-        data = f.readlines()
-    out.remove()
-    rmtree(out_dir)
-    return Response(data, headers={
-        'Content-Type': f"image/{out.ext}"
-    })
+    return image_response(image, encoding, key=key)
 
 @app.route('/api/poi_bbox/<float:w>/<float:n>/<float:e>/<float:s>', methods=['POST'])
 def show_poi_bbox(w, n, e, s):
     ''' Shows an Image contaning the selected bounding-box, adding Points of Interest'''
-    bbox = Bbox(w, n, e, s)
+    coords = quantize((w, n, e, s), PRECISION)
+    bbox = Bbox(*coords)
     content = request.get_json(force=True)
-        
-    if content is not None:
-        try:
-            poi = content['poi']
-            q = SimpleQuery(bbox)
-            for p in poi:
-                q.add_poi(p)
-            res = q.execute()
-            geo_data = res.to_geojson(node_props={"marker": True})
-            geo_data = geojson.dumps(geo_data)
-        except Exception:
-            geo_data = None
-    else:
-        geo_data = None
-
-    # Build a Tile Getter
-    getter = Tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'))
-    
+
     # Optional parameters
     cropped = request.args.get('cropped', False)
     cropped = True if cropped is not False else False
+
+    # Check the caches
+    encoding = output_encoding()
+    key = render_key("poi_bbox", coords, cropped=cropped, poi=poi_list(content), cluster=CLUSTER_CELL, img_type=encoding.format, encoding=encoding.params())
+    cached = cached_response(key, encoding)
+    if cached is not None:
+        return cached
+        
+    geo_data, complete = poi_geojson(bbox, content, cropped)
+
+    # Get the Tile Getter (one per worker, keeping its connections alive)
+    getter = get_tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'), cache=tile_cache, flight=flight)
+    synth = TileSynth(getter, synth_policy, pixel_cache)
     
     # Build image
-    out = draw_image(bbox, getter, watermark="© Mapbox, dataset © OpenStreetMap and contributors", geo_json=geo_data, crop_bbox=cropped)
+    image = render_image(bbox, getter, watermark="© Mapbox, dataset © OpenStreetMap and contributors", geo_json=geo_data, crop_bbox=cropped, pixel_cache=pixel_cache, deadline=DEADLINE, synth=synth)
 
-    path = out.path
-    out_dir = out.dir
-    
-    with open(path, 'rb') as f:
-        data = f.readlines()
-    out.remove()
-    rmtree(out_dir)
-    return Response(data, headers={
-        'Content-Type': f"image/{out.ext}"
-    })
+    return image_response(image, encoding, key=key, complete=complete)
 
 @app.route('/api/point/<lon>/<lat>', methods=['GET', 'POST'])
 def show_point(lon, lat):
@@ -95,86 +286,74 @@ def show_point(lon, lat):
     
     Optionally, some GeoJSON to be rendered can be passed as argument
     '''
-    lonlat = LonLat(float(lon), float(lat))
+    coords = quantize((float(lon), float(lat)), PRECISION)
+    lonlat = LonLat(*coords)
     try:
         content = request.get_json(force=True)
-        content = geojson.dumps(content)
     except Exception:
         content = None
 
-    # Build a Tile Getter
-    getter = Tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'))
-    
     # Optional parameters
     near = int(request.args.get('near', 20))
     cropped = request.args.get('cropped', False)
     cropped = True if not cropped is False else False
 
+    # Check the caches
+    encoding = output_encoding()
+    key = render_key("point", coords, near=near, cropped=cropped, geo_json=content, img_type=encoding.format, encoding=encoding.params())
+    cached = cached_response(key, encoding)
+    if cached is not None:
+        return cached
+    content = geojson.dumps(content) if content is not None else None
+
+    # Get the Tile Getter (one per worker, keeping its connections alive)
+    getter = get_tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'), cache=tile_cache, flight=flight)
+    synth = TileSynth(getter, synth_policy, pixel_cache)
+
     # Build Bbox with radius=near (in meters)
     ne = lonlat.get_offset(near, near)
     sw = lonlat.get_offset(-near, -near)
     bbox = Bbox(sw.lon, ne.lat, ne.lon, sw.lat)
     
     # Build image
-    out = draw_image(bbox, getter, watermark="© Mapbox", geo_json=content, crop_bbox=cropped)
+    image = render_image(bbox, getter, watermark="© Mapbox", geo_json=content, crop_bbox=cropped, pixel_cache=pixel_cache, deadline=DEADLINE, synth=synth)
 
-    path = out.path
-    out_dir = out.dir
-    
-    with open(path, 'rb') as f:
-        data = f.readlines()
-    out.remove()
-    rmtree(out_dir)
-    return Response(data, headers={
-        'Content-Type': f"image/{out.ext}"
-    })
+    return image_response(image, encoding, key=key)
 
 @app.route('/api/poi_point/<float:lon>/<float:lat>', methods=['POST'])
 def show_poi_point(lon, lat):
     ''' Shows an Image near the selected point, adding Points of Interest '''
-    lonlat = LonLat(lon, lat)
+    coords = quantize((lon, lat), PRECISION)
+    lonlat = LonLat(*coords)
     try:
         content = request.get_json(force=True)
     except Exception:
         content = None
     
-    # Build a Tile Getter
-    getter = Tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'))
-    
     # Optional parameters
     near = int(request.args.get('near', 20))
     cropped = request.args.get('cropped', False)
     cropped = True if not cropped is False else False
+
+    # Check the caches
+    encoding = output_encoding()
+    key = render_key("poi_point", coords, near=near, cropped=cropped, poi=poi_list(content), cluster=CLUSTER_CELL, img_type=encoding.format, encoding=encoding.params())
+    cached = cached_response(key, encoding)
+    if cached is not None:
+        return cached
+
+    # Get the Tile Getter (one per worker, keeping its connections alive)
+    getter = get_tileget(os.getenv('MAPBOX_URL'), os.getenv('MAPBOX_TOKEN'), cache=tile_cache, flight=flight)
+    synth = TileSynth(getter, synth_policy, pixel_cache)
     
     # Build Bbox with radius=near (in meters)
     ne = lonlat.get_offset(near, near)
     sw = lonlat.get_offset(-near, -near)
     bbox = Bbox(sw.lon, ne.lat, ne.lon, sw.lat)
 
-    if content is not None:
-        try:
-            poi = content['poi']
-            q = SimpleQuery(bbox)
-            for p in poi:
-                q.add_poi(p)
-            res = q.execute()
-            geo_data = res.to_geojson(node_props={"marker": True})
-            geo_data = geojson.dumps(geo_data)
-        except Exception:
-            geo_data = None
-    else:
-        geo_data = None
+    geo_data, complete = poi_geojson(bbox, content, cropped)
     
     # Build image
-    out = draw_image(bbox, getter, watermark="© Mapbox, dataset © OpenStreetMap and contributors", geo_json=geo_data, crop_bbox=cropped)
+    image = render_image(bbox, getter, watermark="© Mapbox, dataset © OpenStreetMap and contributors", geo_json=geo_data, crop_bbox=cropped, pixel_cache=pixel_cache, deadline=DEADLINE, synth=synth)
 
-    path = out.path
-    out_dir = out.dir
-    
-    with open(path, 'rb') as f:
-        data = f.readlines()
-    out.remove()
-    rmtree(out_dir)
-    return Response(data, headers={
-        'Content-Type': f"image/{out.ext}"
-    })
\ No newline at end of file
+    return image_response(image, encoding, key=key, complete=complete)
\ No newline at end of file
@@ -0,0 +1,9 @@
+'''
+Benchmark suite of geobot, running offline
+
+Run it from the root of the repository with:
+
+    python -m benchmarks.run --out results.json
+
+See benchmarks/README.md
+'''
@@ -0,0 +1,97 @@
+'''
+Fixed inputs of the benchmarks, derived from examples/fountains.geojson
+'''
+import os
+import json
+import math
+import random
+import geojson
+from geobot.geo import Bbox
+
+EXAMPLES_DIR = f"{os.path.dirname(os.path.dirname(os.path.abspath(__file__)))}/examples"
+
+# Bbox of the fountains (examples/fountains.bbox)
+FOUNTAINS_BBOX = Bbox(14.141636, 42.522977, 14.184637, 42.497605)
+
+# Scales of the GeoJSON inputs: how many times the fountains are repeated
+SCALES = (1, 10, 100, 1000)
+
+def fountains():
+    ''' Gets the (lon, lat) of the fountains of the examples '''
+    with open(f"{EXAMPLES_DIR}/fountains.geojson") as f:
+        data = json.load(f)
+    return [tuple(feat['geometry']['coordinates']) for feat in data['features']]
+
+def scaled_geojson(scale, seed=0):
+    '''
+    Gets a FeatureCollection with scale times the fountains, as a dump string
+
+    Every copy of the fountains is jittered inside FOUNTAINS_BBOX (deterministically, given the seed)
+    and adds, besides its markers, a LineString through them and a Polygon around them,
+    so that all the kinds of features drawn by Dtile.render_geojson are measured.
+    '''
+    rnd = random.Random(seed)
+    points = fountains()
+    bbox = FOUNTAINS_BBOX
+    dx = (bbox.east - bbox.west) / 20
+    dy = (bbox.north - bbox.south) / 20
+    features = []
+    for i in range(scale):
+        copy = [
+            (min(max(lon + rnd.uniform(-dx, dx), bbox.west), bbox.east), min(max(lat + rnd.uniform(-dy, dy), bbox.south), bbox.north))
+            for lon, lat in points
+        ] if i > 0 else points
+        for lon, lat in copy:
+            features.append(geojson.Feature(geometry={"type": "Point", "coordinates": [lon, lat], "properties": {"marker": True}}))
+        features.append(geojson.Feature(geometry={"type": "LineString", "coordinates": [list(c) for c in copy]}))
+        west = min(c[0] for c in copy)
+        east = max(c[0] for c in copy)
+        south = min(c[1] for c in copy)
+        north = max(c[1] for c in copy)
+        ring = [[west, north], [west, south], [east, south], [east, north], [west, north]]
+        features.append(geojson.Feature(geometry={"type": "Polygon", "coordinates": [ring]}))
+    return geojson.dumps(geojson.FeatureCollection(features))
+
+def gps_track(n, seed=0):
+    '''
+    Gets a FeatureCollection with a LineString of n vertices spanning FOUNTAINS_BBOX, as a dump string
+
+    It is a walk turning a bit at every step, like a long GPS track (deterministically, given the seed).
+    '''
+    rnd = random.Random(seed)
+    heading = 0.0
+    x, y = 0.0, 0.0
+    walk = []
+    for _ in range(n):
+        heading += rnd.gauss(0, 0.05)
+        x += math.cos(heading)
+        y += math.sin(heading)
+        walk.append((x, y))
+    return geojson.dumps(geojson.FeatureCollection([geojson.Feature(geometry={"type": "LineString", "coordinates": _fit(walk)})]))
+
+def city_polygon(n, seed=0):
+    '''
+    Gets a FeatureCollection with a filled Polygon of n vertices spanning FOUNTAINS_BBOX, as a dump string
+
+    Its ring has a jagged border, like the boundary of a city (deterministically, given the seed).
+    '''
+    rnd = random.Random(seed)
+    ring = []
+    radius = 1.0
+    for i in range(n):
+        angle = 2 * math.pi * i / n
+        radius = min(max(radius + rnd.gauss(0, 0.01), 0.5), 1.0)
+        ring.append((radius * math.cos(angle), radius * math.sin(angle)))
+    ring.append(ring[0])
+    geometry = {"type": "Polygon", "coordinates": [_fit(ring)], "properties": {"outline": [80, 80, 200]}}
+    return geojson.dumps(geojson.FeatureCollection([geojson.Feature(geometry=geometry)]))
+
+def _fit(points):
+    ''' Scales (x, y) points to [lon, lat] coordinates spanning FOUNTAINS_BBOX '''
+    bbox = FOUNTAINS_BBOX
+    xs = [p[0] for p in points]
+    ys = [p[1] for p in points]
+    x0, y0 = min(xs), min(ys)
+    sx = (bbox.east - bbox.west) / ((max(xs) - x0) or 1)
+    sy = (bbox.north - bbox.south) / ((max(ys) - y0) or 1)
+    return [[bbox.west + (x - x0) * sx, bbox.south + (y - y0) * sy] for x, y in points]
@@ -0,0 +1,455 @@
+'''
+Runs the benchmarks, and saves the results as JSON
+
+    python -m benchmarks.run [--out results.json] [--repeat 5] [--only geo --only mosaic] [--compare old.json]
+
+Every benchmark is timed repeat times (after a warm-up call); then its peak memory
+is measured with tracemalloc over one more call, apart, since tracing slows it down.
+'''
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+import geojson
+from PIL import Image
+from geobot.geo import Bbox, LonLat, Tile, PreparedPolygon, lonlat_to_tiles, parse_quadkey, point_in_poly, tileset2bbox
+from geobot.cache import DiskCache, PixelCache
+from geobot.tileget import Tileget, TileFetcher
+from geobot.tiledraw import Dtile
+from geobot.tilerender import get_tiles, get_raw_bbox, degrade_tiles, tiles2mosaic, tiles2image, tiles2region, render_image
+from geobot.renderplan import plan_render
+from geobot.cluster import cluster_geojson
+from geobot.assets import icon_font
+from geobot.encoding import Encoding
+from .inputs import FOUNTAINS_BBOX, SCALES, fountains, scaled_geojson, gps_track, city_polygon
+from .servers import TileServer, OverpassServer
+
+# name: (group, setup); setup(ctx) returns the callable to measure
+BENCHMARKS = {}
+
+def benchmark(name):
+    ''' Registers a benchmark setup under name ("group.case") '''
+    def register(setup):
+        BENCHMARKS[name] = (name.split(".", 1)[0], setup)
+        return setup
+    return register
+
+
+class Context:
+    '''
+    Shared state of the benchmarks: the local servers and a scratch directory, set up once
+    '''
+    def __init__(self, delay=0.0):
+        self.dir = tempfile.mkdtemp(prefix="geobot-bench-")
+        self.tiles = TileServer(delay).start()
+        self.overpass = OverpassServer(delay).start()
+        self._app = None
+
+    def path(self, name):
+        return f"{self.dir}/{name}"
+
+    def getter(self, cache=None):
+        ''' Gets a Tileget on the local tile server (a new one, so that no connection is shared) '''
+        return Tileget(self.tiles.url, cache=cache)
+
+    def app(self):
+        ''' Gets a test client of the Flask app, configured on the local servers and scratch caches '''
+        if self._app is None:
+            os.environ.update({
+                'MAPBOX_URL': self.tiles.url,
+                'MAPBOX_TOKEN': "",
+                'OVERPASS_URL': self.overpass.url,
+                'GEOBOT_TILE_CACHE': self.path("app/tiles"),
+                'GEOBOT_PIXEL_CACHE': self.path("app/pixels"),
+                'GEOBOT_RENDER_CACHE': self.path("app/renders"),
+                'GEOBOT_POI_CACHE': self.path("app/poi"),
+                'GEOBOT_LOCKS': self.path("app/locks"),
+                'GEOBOT_METRICS': self.path("app/metrics"),
+            })
+            sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            import app
+            self._app = app.app.test_client()
+        return self._app
+
+    def close(self):
+        self.tiles.stop()
+        self.overpass.stop()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+# Geo math
+
+@benchmark("geo.infer_zoom")
+def _(ctx):
+    rnd = random.Random(0)
+    bboxes = []
+    for _ in range(1000):
+        lon, lat = rnd.uniform(-170, 170), rnd.uniform(-80, 80)
+        size = 10 ** rnd.uniform(-4, 1)
+        bboxes.append(Bbox(lon, lat + size, lon + size, lat))
+    return lambda: [b.infer_zoom(4) for b in bboxes]
+
+@benchmark("geo.to_tileset")
+def _(ctx):
+    # Italy at zoom 12: about 40k tiles
+    bbox = Bbox(6.6, 47.1, 18.5, 36.6)
+    return lambda: sum(1 for _ in bbox.to_tileset(12))
+
+@benchmark("geo.lonlat_tile")
+def _(ctx):
+    points = [LonLat(lon, lat) for lon, lat in fountains()] * 400
+    return lambda: [p.tile(16) for p in points]
+
+@benchmark("geo.lonlat_to_tiles_array")
+def _(ctx):
+    rnd = np.random.default_rng(0)
+    lons = rnd.uniform(-180, 180, 100000)
+    lats = rnd.uniform(-85, 85, 100000)
+    return lambda: lonlat_to_tiles(lons, lats, 16)
+
+@benchmark("geo.tile_children")
+def _(ctx):
+    tile = Tile(4, 8, 5)
+    return lambda: tile.children(10)
+
+@benchmark("geo.quadkey_roundtrip")
+def _(ctx):
+    rnd = random.Random(0)
+    tiles = [Tile(18, rnd.randrange(2**18), rnd.randrange(2**18)) for _ in range(10000)]
+    return lambda: [parse_quadkey(t.quadkey()) for t in tiles]
+
+@benchmark("geo.point_in_poly")
+def _(ctx):
+    b = FOUNTAINS_BBOX
+    polygon = {"type": "Polygon", "coordinates": [[list(c) for c in fountains()] + [list(fountains()[0])]]}
+    rnd = random.Random(0)
+    points = [LonLat(rnd.uniform(b.west, b.east), rnd.uniform(b.south, b.north)) for _ in range(1000)]
+    return lambda: [point_in_poly(p, polygon) for p in points]
+
+@benchmark("geo.prepared_polygon")
+def _(ctx):
+    polygon = json.loads(city_polygon(5000))["features"][0]["geometry"]
+    b = FOUNTAINS_BBOX
+    rnd = random.Random(0)
+    points = [(rnd.uniform(b.west, b.east), rnd.uniform(b.south, b.north)) for _ in range(10000)]
+    return lambda: PreparedPolygon(polygon).contains_points(points)
+
+
+# Mosaic
+
+def _fetched(ctx, visible_tiles):
+    ''' Gets the tileset of the fountains bbox, and its tiles (bytes), downloaded once '''
+    getter = ctx.getter()
+    tileset, results = get_tiles(FOUNTAINS_BBOX, getter, visible_tiles, ".png", retina=True)
+    return tileset, [r.data for r in results]
+
+@benchmark("mosaic.tiles2mosaic_4")
+def _(ctx):
+    tileset, tiles = _fetched(ctx, 4)
+    return lambda: tiles2mosaic(tileset, tiles)
+
+@benchmark("mosaic.tiles2mosaic_16")
+def _(ctx):
+    tileset, tiles = _fetched(ctx, 16)
+    return lambda: tiles2mosaic(tileset, tiles)
+
+@benchmark("mosaic.tiles2mosaic_16_pixel_cache")
+def _(ctx):
+    tileset, tiles = _fetched(ctx, 16)
+    pixel_cache = PixelCache(ctx.path("pixels"), max_bytes=256 * 2**20)
+    return lambda: tiles2mosaic(tileset, tiles, pixel_cache)
+
+@benchmark("mosaic.tiles2image_16")
+def _(ctx):
+    temp_dir, _, tileset = get_raw_bbox(FOUNTAINS_BBOX, ctx.getter(), 16, ".png", retina=True)
+    def run():
+        out = tiles2image(temp_dir.path, "png", zoom=tileset[0].z)
+        out.remove()
+    return run
+
+
+# GeoJSON overlay
+
+def _overlay(make_geojson):
+    def setup(ctx):
+        tileset, tiles = _fetched(ctx, 4)
+        base = tiles2mosaic(tileset, tiles)
+        geo_json = make_geojson()
+        def run():
+            image = Dtile(None, FOUNTAINS_BBOX, image=base.copy())
+            image.load_iconset_url()
+            image.load_geojson(geo_json)
+            image.render_geojson()
+        return run
+    return setup
+
+for scale in SCALES:
+    benchmark(f"overlay.render_geojson_x{scale}")(_overlay(lambda scale=scale: scaled_geojson(scale)))
+@benchmark("overlay.clustered_x1000")
+def _(ctx):
+    tileset, tiles = _fetched(ctx, 4)
+    base = tiles2mosaic(tileset, tiles)
+    geo_json = geojson.loads(scaled_geojson(1000))
+    def run():
+        image = Dtile(None, FOUNTAINS_BBOX, image=base.copy())
+        image.load_iconset_url()
+        image.load_geojson(geojson.dumps(cluster_geojson(geo_json, FOUNTAINS_BBOX, image.image.size)))
+        image.render_geojson()
+    return run
+
+benchmark("overlay.gps_track_100k")(_overlay(lambda: gps_track(100000)))
+benchmark("overlay.city_polygon_100k")(_overlay(lambda: city_polygon(100000)))
+
+
+# Rendering, stage by stage and end to end
+
+@benchmark("render.fetch_network")
+def _(ctx):
+    fetcher = TileFetcher()
+    return lambda: get_tiles(FOUNTAINS_BBOX, ctx.getter(), 4, ".png", retina=True, fetcher=fetcher)
+
+@benchmark("render.fetch_cached")
+def _(ctx):
+    getter = ctx.getter(cache=DiskCache(ctx.path("tiles")))
+    get_tiles(FOUNTAINS_BBOX, getter, 4, ".png", retina=True)
+    return lambda: get_tiles(FOUNTAINS_BBOX, getter, 4, ".png", retina=True)
+
+@benchmark("render.mosaic")
+def _(ctx):
+    getter = ctx.getter()
+    tileset, results = get_tiles(FOUNTAINS_BBOX, getter, 4, ".png", retina=True)
+    def run():
+        tiles, _ = degrade_tiles(tileset, list(results), retina=True)
+        return tiles2mosaic(tileset, tiles)
+    return run
+
+def _mosaic(ctx):
+    ''' Gets the mosaic of the fountains bbox, and its coordinates '''
+    tileset, tiles = _fetched(ctx, 4)
+    return tiles2mosaic(tileset, tiles), tileset2bbox(tileset)
+
+@benchmark("render.crop")
+def _(ctx):
+    base, coords = _mosaic(ctx)
+    def run():
+        image = Dtile(None, coords, image=base)
+        image.crop_to_coords(FOUNTAINS_BBOX)
+    return run
+
+@benchmark("render.resize")
+def _(ctx):
+    base, _ = _mosaic(ctx)
+    def run():
+        image = Dtile(None, FOUNTAINS_BBOX, image=base)
+        image.harmonious_resize((600, 600))
+    return run
+
+@benchmark("render.compose")
+def _(ctx):
+    getter = ctx.getter()
+    plan = plan_render(FOUNTAINS_BBOX, retina=True)
+    tileset, results = get_tiles(plan.region, getter, img_type=".png", retina=True, zoom=plan.zoom)
+    def run():
+        tiles, _ = degrade_tiles(tileset, list(results), retina=True)
+        return tiles2region(plan, tiles)
+    return run
+
+@benchmark("render.watermark")
+def _(ctx):
+    base, _ = _mosaic(ctx)
+    image = Dtile(None, FOUNTAINS_BBOX, image=base.resize((600, 600)))
+    return lambda: image.watermark("© Mapbox")
+
+def _encode(encoding):
+    def setup(ctx):
+        base, _ = _mosaic(ctx)
+        image = Dtile(None, FOUNTAINS_BBOX, image=base.resize((600, 600)))
+        return lambda: image.to_bytes(encoding=encoding)
+    return setup
+
+for name, encoding in (
+    ("png", Encoding("png")),
+    ("png_fast", Encoding("png", compress_level=1)),
+    ("png_palette", Encoding("png", colors=256)),
+    ("jpeg", Encoding("jpeg")),
+    ("webp", Encoding("webp")),
+):
+    benchmark(f"render.encode_{name}")(_encode(encoding))
+
+@benchmark("render.render_image_network")
+def _(ctx):
+    geo_json = scaled_geojson(10)
+    return lambda: render_image(FOUNTAINS_BBOX, ctx.getter(), geo_json=geo_json, watermark="© Mapbox").to_bytes("png")
+
+@benchmark("render.render_image_cached")
+def _(ctx):
+    geo_json = scaled_geojson(10)
+    getter = ctx.getter(cache=DiskCache(ctx.path("tiles")))
+    pixel_cache = PixelCache(ctx.path("pixels"), max_bytes=256 * 2**20)
+    return lambda: render_image(FOUNTAINS_BBOX, getter, geo_json=geo_json, watermark="© Mapbox", pixel_cache=pixel_cache).to_bytes("png")
+
+
+# Flask endpoints
+
+def _shifted_bbox(i):
+    ''' Gets the fountains bbox moved by i steps of about 10m, so that every request misses the render cache '''
+    b = FOUNTAINS_BBOX
+    d = i * 1e-4
+    return f"{b.west + d:.5f}/{b.north + d:.5f}/{b.east + d:.5f}/{b.south + d:.5f}"
+
+def _counter():
+    count = [0]
+    def next_count():
+        count[0] += 1
+        return count[0]
+    return next_count
+
+@benchmark("endpoint.bbox_render")
+def _(ctx):
+    client = ctx.app()
+    geo_json = json.loads(scaled_geojson(1))
+    step = _counter()
+    return lambda: client.post(f"/api/bbox/{_shifted_bbox(step())}", json=geo_json).get_data()
+
+@benchmark("endpoint.bbox_cached")
+def _(ctx):
+    client = ctx.app()
+    geo_json = json.loads(scaled_geojson(1))
+    url = f"/api/bbox/{_shifted_bbox(-1)}"
+    client.post(url, json=geo_json)
+    return lambda: client.post(url, json=geo_json).get_data()
+
+@benchmark("endpoint.bbox_not_modified")
+def _(ctx):
+    client = ctx.app()
+    url = f"/api/bbox/{_shifted_bbox(-2)}"
+    etag = client.get(url).headers['ETag']
+    return lambda: client.get(url, headers={'If-None-Match': etag}).get_data()
+
+@benchmark("endpoint.poi_bbox_render")
+def _(ctx):
+    client = ctx.app()
+    step = _counter()
+    return lambda: client.post(f"/api/poi_bbox/{_shifted_bbox(-100 - step())}", json={"poi": ["fountain"]}).get_data()
+
+@benchmark("endpoint.point_render")
+def _(ctx):
+    client = ctx.app()
+    step = _counter()
+    lon, lat = fountains()[0]
+    return lambda: client.get(f"/api/point/{lon + step() * 1e-4:.5f}/{lat:.5f}?near=200").get_data()
+
+
+def measure(fn, repeat):
+    ''' Times fn repeat times (after a warm-up call), then measures its peak memory over one more call '''
+    fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    tracemalloc.start()
+    try:
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        "repeat": repeat,
+        "min_ms": min(times),
+        "median_ms": statistics.median(times),
+        "mean_ms": statistics.mean(times),
+        "max_ms": max(times),
+        "peak_kb": peak / 1024
+    }
+
+def git_revision():
+    ''' Gets the current commit (with a + if the tree has changes), or None out of a git checkout '''
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True).stdout.strip()
+        return commit + ("+" if dirty else "")
+    except Exception:
+        return None
+
+def run(only=None, repeat=5, delay=0.0):
+    '''
+    Runs the benchmarks whose name contains any of the strings in only (default: all)
+
+    Returns the results, as a dict ready for JSON
+    '''
+    ctx = Context(delay)
+    results = {}
+    try:
+        for name, (group, setup) in BENCHMARKS.items():
+            if only and not any(o in name for o in only):
+                continue
+            try:
+                result = measure(setup(ctx), repeat)
+            except Exception as e:
+                result = {"error": f"{type(e).__name__}: {e}"}
+            result["group"] = group
+            results[name] = result
+            print(_format(name, result), flush=True)
+    finally:
+        ctx.close()
+    return {
+        "meta": {
+            "revision": git_revision(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": Image.__version__,
+            "numpy": np.__version__,
+            "icon_font": icon_font() is not None,
+            "delay_s": delay,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        },
+        "results": results
+    }
+
+def _format(name, result):
+    if "error" in result:
+        return f"{name:40} error: {result['error']}"
+    return f"{name:40} {result['median_ms']:10.3f} ms (min {result['min_ms']:.3f}) {result['peak_kb']:10.1f} kB peak"
+
+def compare(old, new):
+    ''' Prints the median times of two runs side by side '''
+    print(f"{'benchmark':40} {'old ms':>10} {'new ms':>10} {'ratio':>7}")
+    for name, result in new["results"].items():
+        before = old["results"].get(name, {})
+        if "median_ms" not in result or "median_ms" not in before:
+            continue
+        ratio = result["median_ms"] / before["median_ms"] if before["median_ms"] > 0 else float("inf")
+        print(f"{name:40} {before['median_ms']:10.3f} {result['median_ms']:10.3f} {ratio:7.2f}")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs the geobot benchmarks offline")
+    parser.add_argument("--out", help="file to save the results to, as JSON")
+    parser.add_argument("--repeat", type=int, default=5, help="timed calls of every benchmark (default: 5)")
+    parser.add_argument("--only", action="append", help="run only the benchmarks containing this string (repeatable)")
+    parser.add_argument("--delay", type=float, default=0.0, help="seconds of latency of the local servers (default: 0)")
+    parser.add_argument("--compare", help="results of a previous run (JSON) to compare to")
+    args = parser.parse_args(argv)
+
+    results = run(args.only, args.repeat, args.delay)
+    if args.out is not None:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == "__main__":
+    main()
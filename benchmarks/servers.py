@@ -0,0 +1,159 @@
+'''
+Local stand-ins of the tile server and of the Overpass API, so that the benchmarks run offline
+'''
+import io
+import re
+import json
+import time
+import threading
+import urllib.parse
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image, ImageDraw
+from .inputs import fountains
+
+TILE_PATH = re.compile(r'/(\d+)/(\d+)/(\d+)(@2x)?\.(\w+)')
+GLOBAL_BBOX = re.compile(r'\[bbox:([-\d.e]+), *([-\d.e]+), *([-\d.e]+), *([-\d.e]+)\]')
+STATEMENT = re.compile(r'(node|way|rel|nwr) *\[amenity=(\w+)\] *;')
+
+@lru_cache(maxsize=1024)
+def synthetic_tile(z, x, y, size=256, ext="png"):
+    '''
+    Gets a synthetic tile, encoded as ext, the same for the same arguments
+
+    It is a colored background crossed by a grid of "streets", so that it is about
+    as costly to encode and decode as a real map tile (a flat color would not be).
+    '''
+    image = Image.new('RGB', (size, size), ((x * 40) % 256, (y * 40) % 256, (z * 10) % 256))
+    draw = ImageDraw.Draw(image)
+    step = size // 8
+    for i in range(0, size, step):
+        offset = (i * (x + 7) * (y + 3)) % step
+        draw.line((0, i + offset, size, i), fill=(255, 255, 255), width=3)
+        draw.line((i + offset, 0, i, size), fill=(250, 220, 160), width=2)
+    draw.ellipse((size // 3, size // 3, size // 2, size // 2), fill=(170, 210, 170))
+    out = io.BytesIO()
+    image.save(out, format="JPEG" if ext in ("jpg", "jpeg") else ext.upper())
+    return out.getvalue()
+
+
+class _Server:
+    ''' An HTTP server running in a daemon thread, on a free local port '''
+    handler = None
+
+    def __init__(self, delay=0.0):
+        '''
+        delay: seconds every request is delayed by, to simulate the network latency
+        '''
+        self.delay = delay
+        self.hits = 0
+        server = self
+        class Handler(self.handler):
+            owner = server
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    @property
+    def address(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+class _Handler(BaseHTTPRequestHandler):
+    owner = None
+
+    def reply(self, data, content_type):
+        self.owner.hits += 1
+        if self.owner.delay > 0:
+            time.sleep(self.owner.delay)
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class _TileHandler(_Handler):
+    def do_GET(self):
+        m = TILE_PATH.match(self.path)
+        if m is None:
+            self.send_error(404)
+            return
+        z, x, y = (int(c) for c in m.group(1, 2, 3))
+        size = 512 if m.group(4) else 256
+        ext = m.group(5)
+        self.reply(synthetic_tile(z, x, y, size, ext), f"image/{ext}")
+
+class TileServer(_Server):
+    '''
+    Tile server serving synthetic tiles at /{z}/{x}/{y}[@2x].{ext}
+
+    Use its url as the tile_server_address of a Tileget (or as MAPBOX_URL)
+    '''
+    handler = _TileHandler
+
+    @property
+    def url(self):
+        return self.address
+
+
+class _OverpassHandler(_Handler):
+    def do_POST(self):
+        length = int(self.headers['Content-Length'])
+        query = self.rfile.read(length).decode()
+        if query.startswith('data='):
+            query = urllib.parse.unquote_plus(query[5:])
+        m = GLOBAL_BBOX.search(query)
+        south, west, north, east = (float(c) for c in m.group(1, 2, 3, 4)) if m is not None else (-90, -180, 90, 180)
+        elements = []
+        seen = set()
+        for m in STATEMENT.finditer(query):
+            kind, amenity = m.group(1, 2)
+            if kind in ("node", "nwr"):
+                for node_id, (lon, lat, tags) in enumerate(self.owner.nodes, 1):
+                    if tags.get("amenity") != amenity or ("node", node_id) in seen:
+                        continue
+                    if west <= lon <= east and south <= lat <= north:
+                        seen.add(("node", node_id))
+                        elements.append({"type": "node", "id": node_id, "lat": lat, "lon": lon, "tags": tags})
+            if kind in ("way", "nwr"):
+                for way_id, (ring, tags) in enumerate(self.owner.ways, 1):
+                    if tags.get("amenity") != amenity or ("way", way_id) in seen:
+                        continue
+                    if any(west <= lon <= east and south <= lat <= north for lon, lat in ring):
+                        seen.add(("way", way_id))
+                        elements.append({"type": "way", "id": way_id, "tags": tags,
+                            "geometry": [{"lat": lat, "lon": lon} for lon, lat in ring]})
+        data = json.dumps({"version": 0.6, "elements": elements}).encode()
+        self.reply(data, "application/json")
+
+class OverpassServer(_Server):
+    '''
+    Overpass API answering the queries on the amenities (as built by PoiCache) with the fountains of the examples:
+    every fountain is a node, and every tenth also has a basin, a closed way around it (with its geometry)
+
+    Use its url as the url of the queries (or as OVERPASS_URL)
+    '''
+    handler = _OverpassHandler
+
+    def __init__(self, delay=0.0):
+        super().__init__(delay)
+        self.nodes = [(lon, lat, {"amenity": "fountain"}) for lon, lat in fountains()]
+        d = 0.0002
+        self.ways = [
+            ([(lon - d, lat - d), (lon + d, lat - d), (lon + d, lat + d), (lon - d, lat + d), (lon - d, lat - d)], {"amenity": "fountain"})
+            for lon, lat in fountains()[::10]
+        ]
+
+    @property
+    def url(self):
+        return f"{self.address}/api/interpreter"
@@ -0,0 +1,111 @@
+'''
+Assets (fonts and overlays) needed to draw on the tiles, loaded once per process
+'''
+import os
+import time
+import tempfile
+import threading
+import urllib.request
+from pathlib import Path
+from functools import lru_cache
+from PIL import Image, ImageDraw, ImageFont
+
+FA_URL="https://use.fontawesome.com/releases/v5.15.1/webfonts/fa-regular-400.ttf"
+FA_SOLID_URL="https://use.fontawesome.com/releases/v5.15.1/webfonts/fa-solid-900.ttf"
+
+# Fonts bundled with the package (optional)
+BUNDLED_DIR = f"{os.path.dirname(os.path.abspath(__file__))}/fonts"
+# Fonts downloaded once, and kept for the next runs
+CACHE_DIR = os.getenv('GEOBOT_ASSETS', f"{tempfile.gettempdir()}/geobot/assets")
+# Seconds to wait before trying again a failed download
+RETRY_AFTER = 300
+
+_failures = {}
+_download_lock = threading.Lock()
+
+def font_path(url=FA_SOLID_URL):
+    '''
+    Gets the local path of a font, given its url, or None if it is not available
+
+    The font is looked for in the bundled fonts, then in the cache dir;
+    if it is in neither, it is downloaded into the cache dir.
+    '''
+    name = os.path.basename(url)
+    for directory in (BUNDLED_DIR, CACHE_DIR):
+        path = f"{directory}/{name}"
+        if os.path.isfile(path):
+            return path
+    with _download_lock:
+        path = f"{CACHE_DIR}/{name}"
+        if os.path.isfile(path):
+            return path
+        if time.monotonic() - _failures.get(url, -RETRY_AFTER) < RETRY_AFTER:
+            return None
+        try:
+            Path(CACHE_DIR).mkdir(parents=True, exist_ok=True)
+            with urllib.request.urlopen(url, timeout=10) as fd:
+                data = fd.read()
+            fd, tmp_path = tempfile.mkstemp(dir=CACHE_DIR, prefix=".tmp-")
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+            return path
+        except Exception as e:
+            print(f"Font not available ({url}): {e}")
+            _failures[url] = time.monotonic()
+            return None
+
+@lru_cache(maxsize=None)
+def _truetype(path, size):
+    return ImageFont.truetype(path, size)
+
+def load_font(font, size=20):
+    ''' Gets a TrueType font from a path (or a name known to the system), once per size '''
+    return _truetype(font, size)
+
+def icon_font(url=FA_SOLID_URL, size=20):
+    ''' Gets the icon font given its url, once per size, or None if it is not available '''
+    path = font_path(url)
+    if path is None:
+        return None
+    return _truetype(path, size)
+
+@lru_cache(maxsize=64)
+def watermark_overlay(watermark, bg_color='#000000', color="#ffffff", text_padding=5, alpha=100):
+    '''
+    Gets the watermark as a translucent RGBA image, rendered once per text and colors
+
+    The image is shared: paste it, but do not draw on it.
+    '''
+    font = ImageFont.load_default() # Default font; space for improvements
+    # Gets raw size of watermark text
+    drawing = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    wm_w, wm_h = drawing.textsize(watermark, font)
+
+    # add paddings
+    (wm_w, wm_h)=(wm_w + text_padding, wm_h + text_padding)
+
+    #Create watermark as different image to apply fill, color, and alpha mask
+    wm_image = Image.new('RGB', (wm_w, wm_h), color = bg_color)
+    drawing = ImageDraw.Draw(wm_image)
+    drawing.text((int(text_padding/2),int(text_padding/2)), watermark, fill=color, font=font)
+    wm_image.putalpha(alpha)
+    return wm_image
+
+@lru_cache(maxsize=256)
+def badge_overlay(text, color=(255, 0, 0), text_color="#ffffff", padding=4):
+    '''
+    Gets a badge (a disc with the text, e.g. the count of a cluster of markers) as RGBA image, rendered once per text and colors
+
+    The image is shared: paste it, but do not draw on it.
+    '''
+    font = ImageFont.load_default()
+    drawing = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+    # textsize, as the watermark: textbbox does not support bitmap fonts before Pillow 9.2
+    text_w, text_h = drawing.textsize(text, font)
+    size = max(text_w, text_h) + 2 * padding
+    badge = Image.new('RGBA', (size, size))
+    drawing = ImageDraw.Draw(badge)
+    drawing.ellipse((0, 0, size - 1, size - 1), fill=color, outline=text_color)
+    drawing.text(((size - text_w) // 2, (size - text_h) // 2), text, fill=text_color, font=font)
+    return badge
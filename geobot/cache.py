@@ -0,0 +1,236 @@
+import io
+import os
+import mmap
+import struct
+import time
+import fcntl
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from PIL import Image
+
+class DiskCache:
+    '''
+    Persistent key-value (bytes) cache, stored on disk
+
+    Every entry is a file, named after the hash of its key. Entries are written
+    atomically (temp file + rename), so different processes (e.g., the gunicorn workers)
+    can share the same cache directory safely.
+    The modification time of a file is its write time (used for the TTL),
+    its access time is the last time it was read (used for the LRU eviction).
+    When the total size exceeds max_bytes, the least recently used entries are evicted.
+    '''
+    def __init__(self, path, max_bytes=256 * 2**20, ttl=7 * 24 * 3600, low_watermark=0.9):
+        '''
+        path: directory of the cache (created if missing)
+        max_bytes: byte budget of the cache
+        ttl: seconds an entry is valid after being written; None means forever
+        low_watermark: fraction of max_bytes the eviction brings the cache back to
+        '''
+        self.path = path.rstrip("/")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.low_watermark = low_watermark
+        Path(self.path).mkdir(parents=True, exist_ok=True)
+        self.lock_path = f"{self.path}/.lock"
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # bytes written by this process since the last size check
+        self._pending = None
+        self._counters = threading.Lock()
+
+    def key_path(self, key):
+        ''' Gets the file path of a key (any object with a stable repr) '''
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return f"{self.path}/{digest[:2]}/{digest}"
+
+    def open(self, key, count=True):
+        '''
+        Opens the file of the entry stored under key (for reading, binary), or returns None
+
+        The caller must close the file.
+        count: whether the lookup is counted in the stats (not for a recheck of a lookup already counted)
+        '''
+        path = self.key_path(key)
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            self._count(misses=int(count))
+            return None
+        st = os.fstat(f.fileno())
+        if self.ttl is not None and time.time() - st.st_mtime > self.ttl:
+            f.close()
+            self._count(misses=int(count))
+            return None
+        try:
+            # refresh the access time for the LRU
+            os.utime(path, (time.time(), st.st_mtime))
+        except OSError:
+            pass
+        self._count(hits=int(count))
+        return f
+
+    def get(self, key, count=True):
+        ''' Gets the bytes stored under key, or None (count: see open) '''
+        f = self.open(key, count)
+        if f is None:
+            return None
+        with f:
+            return f.read()
+
+    def put(self, key, data):
+        ''' Stores the bytes under key, evicting old entries if the budget is exceeded '''
+        path = self.key_path(key)
+        directory = os.path.dirname(path)
+        Path(directory).mkdir(exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+        self._pending = self.max_bytes if self._pending is None else self._pending + len(data)
+        # The directory is scanned only when enough data has been written
+        if self._pending > self.max_bytes * (1 - self.low_watermark):
+            self._pending = 0
+            self.evict()
+
+    def remove(self, key):
+        ''' Removes the entry stored under key, if present '''
+        try:
+            os.remove(self.key_path(key))
+        except OSError:
+            pass
+
+    def entries(self):
+        ''' Gets a list of (path, stat) of all the entries '''
+        entries = []
+        for sub in os.scandir(self.path):
+            if not sub.is_dir():
+                continue
+            for entry in os.scandir(sub.path):
+                if entry.name.startswith(".tmp-"):
+                    continue
+                try:
+                    entries.append((entry.path, entry.stat()))
+                except OSError:
+                    pass
+        return entries
+
+    def evict(self, max_bytes=None):
+        '''
+        Removes expired entries, then the least recently used ones
+        until the cache fits max_bytes * low_watermark (default: the cache budget)
+
+        Eviction holds an exclusive lock, so only one process at a time evicts.
+        Returns the number of evicted entries
+        '''
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        evicted = 0
+        with open(self.lock_path, 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                now = time.time()
+                entries = []
+                for path, st in self.entries():
+                    if self.ttl is not None and now - st.st_mtime > self.ttl:
+                        evicted += self._unlink(path)
+                    else:
+                        entries.append((st.st_atime, st.st_size, path))
+                total = sum(size for _, size, _ in entries)
+                if total > max_bytes:
+                    target = max_bytes * self.low_watermark
+                    for _, size, path in sorted(entries):
+                        if total <= target:
+                            break
+                        evicted += self._unlink(path)
+                        total -= size
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        self._count(evictions=evicted)
+        return evicted
+
+    def clear(self):
+        ''' Removes all the entries '''
+        return self.evict(max_bytes=0)
+
+    def stats(self):
+        ''' Gets the counters of this process, and the current size of the cache '''
+        entries = self.entries()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": len(entries),
+            "bytes": sum(st.st_size for _, st in entries),
+            "max_bytes": self.max_bytes,
+        }
+
+    def _unlink(self, path):
+        try:
+            os.remove(path)
+            return 1
+        except OSError:
+            return 0
+
+    def _count(self, hits=0, misses=0, evictions=0):
+        with self._counters:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+
+def shm_path(name):
+    ''' Gets a path in shared memory (/dev/shm), or in the temp dir if there is no shared memory '''
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+    return f"{base}/{name}"
+
+
+class PixelCache(DiskCache):
+    '''
+    Cache of decoded tiles, stored as raw RGB pixel buffers
+
+    It is meant to live in shared memory (see shm_path): the buffers are memory-mapped,
+    so all the workers share the same pages, and reusing a tile costs no decoding.
+    Tiles are addressed by the hash of their encoded bytes.
+    '''
+    HEADER = struct.Struct("<4sII")
+
+    def __init__(self, path, max_bytes=128 * 2**20, ttl=None, low_watermark=0.9):
+        super().__init__(path, max_bytes, ttl, low_watermark)
+
+    def get_image(self, key):
+        ''' Gets the image stored under key, backed by the mapped buffer, or None '''
+        f = self.open(key)
+        if f is None:
+            return None
+        with f:
+            try:
+                buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (OSError, ValueError):
+                return None
+        mode, w, h = self.HEADER.unpack_from(buffer)
+        mode = mode.rstrip(b"\0").decode()
+        return Image.frombuffer(mode, (w, h), memoryview(buffer)[self.HEADER.size:], "raw", mode, 0, 1)
+
+    def put_image(self, key, image):
+        ''' Stores the pixels of the image under key '''
+        header = self.HEADER.pack(image.mode.encode(), image.width, image.height)
+        self.put(key, header + image.tobytes())
+
+    def decode(self, data):
+        ''' Decodes an encoded tile (e.g., PNG bytes) as RGB image, through the cache '''
+        key = hashlib.sha1(data).hexdigest()
+        image = self.get_image(key)
+        if image is None:
+            image = Image.open(io.BytesIO(data)).convert("RGB")
+            self.put_image(key, image)
+        return image
@@ -0,0 +1,62 @@
+'''
+Clustering of the markers at the pixel scale of the output image
+
+Markers that would collide are merged into one, with their count (drawn as a badge, see overlay),
+so that the cost of drawing them is bounded by the size of the image, not by their number.
+'''
+import math
+import numpy as np
+import geojson
+from .geo import Bbox, project_to_pixels
+
+# Size of the cells of the grid, in pixels of the output (about the size of a marker)
+CELL = 32
+
+def cluster_points(coords, bbox: Bbox, size, cell=CELL):
+    '''
+    Groups N (lon, lat) points by the cells of a grid over the image (w, h) of the bbox
+
+    The points outside the image are dropped. Returns a list of (lon, lat, count, first), one per cell
+    with points (row by row): the mean of its points, how many they are, and the index of the first one;
+    there are at most (w / cell) * (h / cell) of them.
+    '''
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    if len(coords) == 0:
+        return []
+    w, h = size
+    pixels = project_to_pixels(coords, bbox, size)
+    inside = np.flatnonzero((pixels[:, 0] >= 0) & (pixels[:, 0] < w) & (pixels[:, 1] >= 0) & (pixels[:, 1] < h))
+    cells = (pixels[inside, 1] // cell).astype(int) * math.ceil(w / cell) + (pixels[inside, 0] // cell).astype(int)
+    _, first, inverse, counts = np.unique(cells, return_index=True, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+    lons = np.bincount(inverse, coords[inside, 0]) / counts
+    lats = np.bincount(inverse, coords[inside, 1]) / counts
+    return [(float(lon), float(lat), int(c), int(i)) for lon, lat, c, i in zip(lons, lats, counts, inside[first])]
+
+def cluster_geojson(fc, bbox: Bbox, size, cell=CELL):
+    '''
+    Gets a GeoJSON FeatureCollection with its Point features clustered (see cluster_points)
+
+    Every cluster keeps the properties of its first point, plus the "count" of its points if more than one;
+    the other features are kept as they are.
+    '''
+    points = []
+    features = []
+    for f in fc['features']:
+        geometry = f.get('geometry') or {}
+        if geometry.get('type') == 'Point':
+            points.append(f)
+        else:
+            features.append(f)
+    coords = [p['geometry']['coordinates'][:2] for p in points]
+    for lon, lat, count, first in cluster_points(coords, bbox, size, cell):
+        props = dict(points[first]['geometry'].get('properties') or {})
+        if count > 1:
+            props['count'] = count
+        point = geojson.Point((lon, lat))
+        point["properties"] = props
+        features.append(geojson.Feature(geometry=point))
+    clustered = geojson.FeatureCollection(features)
+    if 'properties' in fc:
+        clustered['properties'] = fc['properties']
+    return clustered
@@ -0,0 +1,119 @@
+'''
+Encoding of the rendered images: format (PNG, JPEG, WebP), quality, compression and palette
+'''
+import io
+import time
+from dataclasses import dataclass
+from PIL import Image
+from .metrics import REGISTRY
+
+# format: (Pillow format, mimetype)
+FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+ALIASES = {"jpg": "jpeg"}
+# Preferred formats, when the client accepts more than one equally
+PREFERENCE = ("webp", "png", "jpeg")
+# Default quality of the lossy formats
+DEFAULT_QUALITY = {"jpeg": 85, "webp": 80}
+
+ENCODE_SECONDS = REGISTRY.histogram("geobot_encode_seconds", "Duration of the encoding of the images", ("format",))
+ENCODED_BYTES = REGISTRY.histogram("geobot_encoded_bytes", "Size of the encoded images", ("format",),
+    buckets=(2**14, 2**15, 2**16, 2**17, 2**18, 2**19, 2**20, 2**21))
+
+class EncodingError(ValueError):
+    ''' Raised when the encoding options are not valid '''
+
+@dataclass(frozen=True)
+class Encoding:
+    '''
+    How to encode an image
+
+    format: png, jpeg (or jpg) or webp, also as file extension (".png")
+    quality: quality of jpeg and webp, 1-100 (default: 85 for jpeg, 80 for webp); ignored by png
+    compress_level: zlib compression of png, 0 (none, fastest) - 9 (smallest, slowest) (default: 6); ignored by the others
+    colors: if given, png images are quantized to an adaptive palette of so many colors (2-256),
+        much smaller to store; ignored by the others
+    '''
+    format: str = "png"
+    quality: int = None
+    compress_level: int = None
+    colors: int = None
+
+    def __post_init__(self):
+        fmt = str(self.format).lower().lstrip(".")
+        fmt = ALIASES.get(fmt, fmt)
+        if fmt not in FORMATS:
+            raise EncodingError(f"Unknown format: {self.format} (known: {', '.join(FORMATS)})")
+        object.__setattr__(self, "format", fmt)
+        _check_range("quality", self.quality, 1, 100)
+        _check_range("compress_level", self.compress_level, 0, 9)
+        _check_range("colors", self.colors, 2, 256)
+
+    @property
+    def mimetype(self):
+        return FORMATS[self.format][1]
+
+    @property
+    def ext(self):
+        return self.format
+
+    def params(self):
+        ''' Gets the options that change the output, as dict (e.g., for the key of a render) '''
+        params = {"format": self.format}
+        if self.format == "png":
+            params.update(compress_level=self.compress_level, colors=self.colors)
+        else:
+            params.update(quality=self.quality)
+        return params
+
+    def encode(self, image: Image.Image):
+        ''' Gets the image encoded, recording the duration and the size in the metrics '''
+        start = time.perf_counter()
+        options = {}
+        if self.format == "png":
+            if self.colors is not None:
+                image = image.quantize(colors=self.colors, method=Image.FASTOCTREE)
+            if self.compress_level is not None:
+                options["compress_level"] = self.compress_level
+        else:
+            options["quality"] = self.quality if self.quality is not None else DEFAULT_QUALITY[self.format]
+            if self.format == "jpeg" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+        out = io.BytesIO()
+        image.save(out, format=FORMATS[self.format][0], **options)
+        data = out.getvalue()
+        ENCODE_SECONDS.observe(time.perf_counter() - start, format=self.format)
+        ENCODED_BYTES.observe(len(data), format=self.format)
+        return data
+
+def _check_range(name, value, low, high):
+    if value is not None and not (isinstance(value, int) and low <= value <= high):
+        raise EncodingError(f"{name} must be an integer between {low} and {high}")
+
+def negotiate(accept, default="png"):
+    '''
+    Gets the format to encode into, out of the Accept header of a request
+
+    The formats explicitly accepted are preferred by their q-value, then by PREFERENCE;
+    if none is (e.g., no header, or just */*), the default.
+    '''
+    if not accept:
+        return default
+    accepted = {}
+    for item in accept.split(","):
+        mimetype, *params = (p.strip() for p in item.split(";"))
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        accepted[mimetype.lower()] = q
+    candidates = [(accepted[FORMATS[f][1]], -PREFERENCE.index(f), f) for f in PREFERENCE if accepted.get(FORMATS[f][1], 0) > 0]
+    if len(candidates) == 0:
+        return default
+    return max(candidates)[2]
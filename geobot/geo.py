@@ -3,6 +3,7 @@ Shoutout: some algorithms heavily inspired by https://github.com/mapbox/mercanti
 '''
 import math
 import geojson
+import numpy as np
 from dataclasses import dataclass
 
 class GeoError(Exception):
@@ -11,25 +12,58 @@ class GeoError(Exception):
 class ParseError(GeoError):
     ''' Raised when parsing '''
 
+# Max zoom of the tile servers
+MAX_ZOOM = 18
+# Max latitude of the tiles (Web Mercator), north and south
+MAX_LAT = 85.051129
 
-@dataclass
-class Bbox:
+# Tile ids: 64 bit integers (signed, so they also fit SQLite) packing the zoom in the lowest ZOOM_BITS bits,
+# and above them the Morton code of the tile (bits of y and x interleaved, as the digits of its quadkey),
+# left-aligned to MAX_ID_ZOOM levels. Sorting by id is sorting in Z-order, every ancestor before its descendants,
+# and the descendants of a tile are a contiguous range of ids.
+ZOOM_BITS = 5
+MAX_ID_ZOOM = 29
+
+
+class _Slotted:
+    '''
+    Base of the geometry value types: frozen (hashable, so usable as cache keys) and slotted (no per-instance __dict__)
+
+    Frozen slotted instances cannot be restored attribute by attribute, so they are pickled (and copied) as tuples.
+    '''
+    __slots__ = ()
+
+    def __getstate__(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setstate__(self, state):
+        for name, value in zip(self.__slots__, state):
+            object.__setattr__(self, name, value)
+
+
+@dataclass(frozen=True)
+class Bbox(_Slotted):
     '''
     Class that represents a boundng box, as a West (lon), North (lat), East (lon), South (lat) coordinates.
     
     It can be thought of also as X1, Y1, X2, Y2 bounding box (it makes more sense in the first quadrant geometry),
     as a way to correlate longitude and latitude to the cartesian plane.
     '''
+    __slots__ = ("west", "north", "east", "south")
     west: float
     north: float
     east: float
     south: float
 
     def __post_init__(self):
-        self.west  = min(self.west, self.east)
-        self.north = max(self.north, self.south)
-        self.east  = max(self.west, self.east)
-        self.south = min(self.north, self.south)
+        # Both bounds out of the given ones, before any is overwritten
+        west, east = min(self.west, self.east), max(self.west, self.east)
+        south, north = min(self.north, self.south), max(self.north, self.south)
+        # Frozen: the fields are set bypassing __setattr__
+        object.__setattr__(self, "west", west)
+        object.__setattr__(self, "north", north)
+        object.__setattr__(self, "east", east)
+        object.__setattr__(self, "south", south)
 
     def to_tuple(self):
         ''' Returns a tuple of its coordinates (Raw Bbox) '''
@@ -39,16 +73,17 @@ class Bbox:
         ''' Returns a tuple of its coordinates for use with OSM data '''
         return(self.south, self.west, self.north, self.east)
 
-    def to_tileset(self, zoom):
+    def tile_ranges(self, zoom):
         '''
-        Returns all the tiles overlapped by a the Bbox at a set zoom.
+        Returns the ranges of the tiles overlapped by the Bbox at a set zoom, as (x1, x2, y1, y2) tuples (inclusive).
 
+        There are two ranges if the box is straddling the line of change of date, one otherwise.
         zoom: is the given tileset zoom
         '''
         # Constant. Useful to avoid limit cases
         DELTA = 1e-11
         
-        tileset = []
+        ranges = []
         ll1 = ragularize_lonlat(self.east, self.north)
         ll2 = ragularize_lonlat(self.west, self.south)
         east, north = ll1.lon, ll1.lat
@@ -65,9 +100,9 @@ class Bbox:
         for west, north, east, south  in bboxes:
             # Clamp bounding values.
             w = max(-180.0, west)
-            n = min(85.051129, north)
+            n = min(MAX_LAT, north)
             e = min(180.0, east)        
-            s = max(-85.051129, south)
+            s = max(-MAX_LAT, south)
             first_tile = LonLat(w, n).tile(zoom)
             last_tile = LonLat(e - DELTA, s + DELTA).tile(zoom)
             x1 = first_tile.x
@@ -78,30 +113,59 @@ class Bbox:
                 x1, x2 = x2, x1
             if y1 > y2:
                 y1, y2 = y2, y1
-            
-            for i in range(x1, x2 + 1):
-                for j in range(y1, y2 + 1):
-                    tileset.append(Tile(zoom, i, j))
+            ranges.append((x1, x2, y1, y2))
 
-        return tileset
+        return ranges
+
+    def tile_span(self, zoom):
+        ''' Returns the number of tiles (columns, rows) overlapped by the Bbox at a set zoom, without building them '''
+        ranges = self.tile_ranges(zoom)
+        columns = sum(x2 - x1 + 1 for x1, x2, _, _ in ranges)
+        rows = max(y2 - y1 + 1 for _, _, y1, y2 in ranges)
+        return (columns, rows)
+
+    def tile_count(self, zoom):
+        ''' Returns the number of tiles overlapped by the Bbox at a set zoom, without building them '''
+        return sum((x2 - x1 + 1) * (y2 - y1 + 1) for x1, x2, y1, y2 in self.tile_ranges(zoom))
+
+    def to_tileset(self, zoom):
+        '''
+        Returns all the tiles overlapped by a the Bbox at a set zoom, as a TileRange (no tile is built).
+
+        zoom: is the given tileset zoom
+        '''
+        ranges = self.tile_ranges(zoom)
+        x1, x2, y1, y2 = ranges[0]
+        if len(ranges) == 2:
+            # Straddling the line of change of date: from the east range, around to the west one
+            east_x1 = ranges[1][0]
+            x1, x2 = (east_x1, x2) if east_x1 > x2 + 1 else (0, 2**zoom - 1)
+        return TileRange(zoom, x1, x2, y1, y2)
 
     def infer_zoom(self, visible_tiles=None):
         '''
         Infers the max zoom at which the Bbox is visible in its entirety in n visible tiles (default 1)
 
-        The algorythm uses a brute-force method.
+        The number of tiles grows with the zoom, so the algorythm uses a binary search
+        over the zoom levels, counting the tiles without building them.
         '''
         visible_tiles = 1 if visible_tiles is None else visible_tiles
         
         if (visible_tiles != int(visible_tiles)) or (visible_tiles < 1):
             raise ParseError("Visible tile number must be a non-negative integer, 1 or more")
-        zoom = 0
-        while visible_tiles >= len(self.to_tileset(zoom + 1)):
-            zoom += 1
-        if visible_tiles > len(self.to_tileset(zoom)):
+        # Max zoom at which the Bbox fits in visible_tiles (at zoom 0 it is always 1 tile)
+        low, high = 0, MAX_ZOOM + 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.tile_count(mid) <= visible_tiles:
+                low = mid
+            else:
+                high = mid - 1
+        zoom = low
+        if zoom <= MAX_ZOOM and visible_tiles > self.tile_count(zoom):
             zoom += 1
         # up to 18 max
-        zoom = 18 if zoom > 18 else zoom
+        zoom = MAX_ZOOM if zoom > MAX_ZOOM else zoom
         return zoom
     
     def fit_tileset(self, visible_tiles=None):
@@ -112,22 +176,7 @@ class Bbox:
 
         visible_tiles: is the given tileset dimension (approx)
         '''
-        visible_tiles = 1 if visible_tiles is None else visible_tiles
-        
-        if (visible_tiles != int(visible_tiles)) or (visible_tiles < 1):
-            raise ParseError("Visible tile number must be a non-negative integer, 1 or more")
-        
-        zoom = 0
-        tileset = self.to_tileset(zoom)
-        while visible_tiles >= len(self.to_tileset(zoom + 1)):
-            zoom += 1
-            # up to 18 max
-            if zoom > 18:
-                break
-            tileset = self.to_tileset(zoom)
-        if visible_tiles > len(self.to_tileset(zoom)):
-            tileset = self.to_tileset(zoom + 1)
-        return tileset
+        return self.to_tileset(self.infer_zoom(visible_tiles))
 
     def to_geojson(self, props=None):
         ''' Gets the Bbox as GeoJSON Polygon '''
@@ -140,9 +189,10 @@ class Bbox:
             p["properties"] = props
         return p
 
-@dataclass
-class Tile:
+@dataclass(frozen=True)
+class Tile(_Slotted):
     ''' Class that represents a Tile, as a Zoom plus X, Y coordinates '''
+    __slots__ = ("z", "x", "y")
     z: int
     x: int
     y: int
@@ -165,34 +215,25 @@ class Tile:
             x = self.x
             y = self.y
         
-        n = 2.0 ** self.z
-        lon_deg = x / n * 360.0 - 180.0
-        lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
-        lat_deg = math.degrees(lat_rad)
+        lon_deg, lat_deg = _tile_to_lonlat(x, y, self.z)
         return LonLat(lon_deg, lat_deg)
     
     def to_bbox(self):
         ''' Returns a Bbox containing the whole tile '''
-        ul = self.longlat(center=False, lr = False)
-        lr = self.longlat(center=False, lr = True)
-        west = ul.lon
-        north = ul.lat
-        east = lr.lon
-        south = lr.lat
+        west, north = _tile_to_lonlat(self.x, self.y, self.z)
+        east, south = _tile_to_lonlat(self.x + 1, self.y + 1, self.z)
         return Bbox(min(west, east), max(south, north), max(west, east), min(south, north))
 
     def quadkey(self):
         ''' Gets the Quadkey of the tile '''
-        key = []
-        for z in range(self.z, 0, -1):
-            digit = 0
-            mask = 1 << (z - 1)
-            if self.x & mask:
-                digit += 1
-            if self.y & mask:
-                digit += 2
-            key.append(str(digit))
-        return "".join(key)
+        code = morton(self.x, self.y)
+        return "".join(QUADKEY_DIGITS[(code >> 2 * i) & 3] for i in range(self.z - 1, -1, -1))
+
+    def tile_id(self):
+        ''' Gets the id of the tile, a 64 bit integer (see parse_tile_id) '''
+        if not 0 <= self.z <= MAX_ID_ZOOM:
+            raise ParseError(f"Tile ids are defined up to zoom {MAX_ID_ZOOM}")
+        return morton(self.x, self.y) << (2 * (MAX_ID_ZOOM - self.z) + ZOOM_BITS) | self.z
     
     def parent(self, zoom=None):
         '''
@@ -208,19 +249,8 @@ class Tile:
         elif self.z == 0:
             raise ParseError("Current tile is Tile(0): can't have a parent")
                         
-        return_tile = Tile(self.z, self.x, self.y)
-
-        while return_tile.z > zoom:
-            x, y, z = return_tile.x, return_tile.y, return_tile.z
-            if x % 2 == 0 and y % 2 == 0:
-                return_tile = Tile( z - 1, x // 2, y // 2)
-            elif x % 2 == 0:
-                return_tile = Tile( z - 1, x // 2, (y - 1) // 2)
-            elif not x % 2 == 0 and y % 2 == 0:
-                return_tile = Tile( z - 1, (x - 1) // 2, y // 2)
-            else:
-                return_tile = Tile( z - 1, (x - 1) // 2, (y - 1) // 2)
-        return return_tile
+        shift = self.z - zoom
+        return Tile(zoom, self.x >> shift, self.y >> shift)
 
     def children(self, zoom=None):
         '''
@@ -234,23 +264,73 @@ class Tile:
         elif self.z > zoom: 
             raise ParseError(f"Children zoom(requested: {zoom}) must be greater than current tile zoom({self.z})")
         
-        curr_tile = Tile(self.z, self.x, self.y)
-        return_tileset =[curr_tile]
-
-        while return_tileset[0].z < zoom:
-            t = return_tileset.pop(0)
-            return_tileset += [
-                Tile(t.z + 1, t.x * 2, t.y * 2),
-                Tile(t.z + 1, t.x * 2 + 1, t.y * 2),
-                Tile(t.z + 1, t.x * 2 + 1, t.y * 2 + 1),
-                Tile(t.z + 1, t.x * 2, t.y * 2 + 1),
-            ]
-        return return_tileset
-
-@dataclass
-class LonLat:
-    ''' Represents a geographic point as (Longitude, Latitude) '''
+        tileset = [self]
+        for z in range(self.z + 1, zoom + 1):
+            tileset = [Tile(z, t.x << 1 | dx, t.y << 1 | dy) for t in tileset for dx, dy in CHILDREN_ORDER]
+        return tileset
 
+# Order of the four children of a tile, as (x, y) offsets: upper-left, upper-right, lower-right, lower-left
+CHILDREN_ORDER = ((0, 0), (1, 0), (1, 1), (0, 1))
+
+@dataclass(frozen=True)
+class TileRange(_Slotted):
+    '''
+    Class that represents all the tiles of a rectangle at a zoom, without building them
+
+    Columns go from x1 to x2, rows from y1 to y2 (inclusive).
+    If x1 > x2 the range is straddling the line of change of date: columns go from x1 east, around to x2.
+    It supports len(), membership, iteration and indexing (also slices, building only the tiles in the slice);
+    tiles are in column order, from west to east, and from north to south within a column.
+    '''
+    __slots__ = ("z", "x1", "x2", "y1", "y2")
+    z: int
+    x1: int
+    x2: int
+    y1: int
+    y2: int
+
+    @property
+    def width(self):
+        ''' Number of columns '''
+        return (self.x2 - self.x1) % 2**self.z + 1
+
+    @property
+    def height(self):
+        ''' Number of rows '''
+        return self.y2 - self.y1 + 1
+
+    def columns(self):
+        ''' Returns the x coordinates of the columns, from west to east '''
+        n = 2**self.z
+        return [(self.x1 + i) % n for i in range(self.width)]
+
+    def __len__(self):
+        return self.width * self.height
+
+    def __contains__(self, tile):
+        if not isinstance(tile, Tile) or tile.z != self.z or not self.y1 <= tile.y <= self.y2:
+            return False
+        return (tile.x - self.x1) % 2**self.z < self.width
+
+    def __iter__(self):
+        for x in self.columns():
+            for y in range(self.y1, self.y2 + 1):
+                yield Tile(self.z, x, y)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(len(self))[index]]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("TileRange index out of range")
+        column, row = divmod(index, self.height)
+        return Tile(self.z, (self.x1 + column) % 2**self.z, self.y1 + row)
+
+@dataclass(frozen=True)
+class LonLat(_Slotted):
+    ''' Represents a geographic point as (Longitude, Latitude) '''
+    __slots__ = ("lon", "lat")
     lon: float
     lat: float
 
@@ -258,11 +338,8 @@ class LonLat:
         '''
         Gets X and Y for a given coordinate at given zoom-level
         '''
-        lat_rad = math.radians(self.lat)
-        n = 2.0 ** zoom
-        x = int((self.lon + 180.0) / 360.0 * n)
-        y = int((1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n)
-        return Tile(zoom, x, y)
+        x, y = _lonlat_to_tile(self.lon, self.lat, zoom)
+        return Tile(zoom, int(x), int(y))
     
     def to_geojson(self, props=None):
         ''' Gets the LonLat as GeoJSON Point '''
@@ -298,6 +375,114 @@ class LonLat:
         return LonLat(lon, lat)
 
 
+# Scalar versions of the kernels below, for the methods of Tile and LonLat:
+# on a single point, plain math is several times faster than building arrays.
+
+def _lonlat_to_tile(lon, lat, zoom):
+    ''' Gets the fractional tile coordinates (x, y) of a (lon, lat) point at given zoom-level '''
+    lat_rad = math.radians(float(lat))
+    n = 2.0 ** zoom
+    x = (float(lon) + 180.0) / 360.0 * n
+    y = (1.0 - math.log(math.tan(lat_rad) + (1 / math.cos(lat_rad))) / math.pi) / 2.0 * n
+    return x, y
+
+def _tile_to_lonlat(x, y, zoom):
+    ''' Gets the (lon, lat) of tile coordinates at given zoom-level '''
+    n = 2.0 ** zoom
+    lon_deg = x / n * 360.0 - 180.0
+    lat_deg = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+    return lon_deg, lat_deg
+
+# Vectorized kernels: they take arrays (or anything numpy can turn into arrays) of N coordinates,
+# and return arrays.
+
+def lonlat_to_tiles(lons, lats, zoom):
+    '''
+    Gets X and Y of the tiles containing N (lon, lat) points at given zoom-level
+
+    Returns two integer arrays (xs, ys)
+    '''
+    xs, ys = lonlat_to_tile_coords(lons, lats, zoom)
+    return np.trunc(xs).astype(np.int64), np.trunc(ys).astype(np.int64)
+
+def lonlat_to_tile_coords(lons, lats, zoom):
+    '''
+    Gets the fractional tile coordinates of N (lon, lat) points at given zoom-level
+
+    The integer part is the tile, the fractional part the position inside the tile
+    (multiplied by the tile size, it is the pixel). Returns two float arrays (xs, ys)
+    '''
+    lat_rad = np.radians(np.asarray(lats, dtype=float))
+    n = 2.0 ** zoom
+    xs = (np.asarray(lons, dtype=float) + 180.0) / 360.0 * n
+    ys = (1.0 - np.log(np.tan(lat_rad) + (1 / np.cos(lat_rad))) / np.pi) / 2.0 * n
+    return xs, ys
+
+def tiles_to_lonlat(xs, ys, zoom):
+    '''
+    Gets the (lon, lat) of N tile coordinates at given zoom-level
+
+    Integer coordinates are the upper-left corners of the tiles; add 0.5 for the centers.
+    Returns two float arrays (lons, lats)
+    '''
+    n = 2.0 ** zoom
+    lons = np.asarray(xs, dtype=float) / n * 360.0 - 180.0
+    lats = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * np.asarray(ys, dtype=float) / n))))
+    return lons, lats
+
+def tiles_to_bounds(xs, ys, zoom):
+    '''
+    Gets the bounds of N tiles at given zoom-level
+
+    Returns four float arrays (wests, norths, easts, souths)
+    '''
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    wests, norths = tiles_to_lonlat(xs, ys, zoom)
+    easts, souths = tiles_to_lonlat(xs + 1, ys + 1, zoom)
+    return wests, norths, easts, souths
+
+def lonlat_to_mercator(lons, lats):
+    '''
+    Projects N (lon, lat) points to Web Mercator (EPSG:3857)
+
+    Returns two float arrays (xs, ys), in meters
+    '''
+    # Earth Radius approximation
+    R = 6378137.0
+    xs = R * np.radians(np.asarray(lons, dtype=float))
+    ys = R * np.log(np.tan(np.pi / 4 + np.radians(np.asarray(lats, dtype=float)) / 2))
+    return xs, ys
+
+def points_to_pixels(coords, reference_coords, ratio):
+    '''
+    Shifts N (lon, lat) points to the reference coordinates, and scales them by the ratio (geo entity per pixel)
+
+    Returns an (N, 2) float array of (x, y), with y growing upwards
+    '''
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    return (coords - np.asarray(reference_coords, dtype=float)) / np.asarray(ratio, dtype=float)
+
+def project_to_pixels(coords, bbox: Bbox, size, flip=True):
+    '''
+    Projects N (lon, lat) points onto an image of given size (w, h) covering the bbox, in Web Mercator as the tiles
+
+    Returns an (N, 2) float array of (x, y) pixel coordinates;
+    if flip=True, y grows downwards as in images, otherwise upwards from the south edge
+    '''
+    w, h = size
+    coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+    # Mercator is linear in longitude: only the latitudes need projecting
+    lats = np.clip(coords[:, 1], -MAX_LAT, MAX_LAT)
+    _, ys = lonlat_to_tile_coords(0.0, lats, 0)
+    _, (top, bottom) = lonlat_to_tile_coords(0.0, (min(bbox.north, MAX_LAT), max(bbox.south, -MAX_LAT)), 0)
+    pixels = np.empty_like(coords)
+    pixels[:, 0] = (coords[:, 0] - bbox.west) / abs(bbox.east - bbox.west) * w
+    pixels[:, 1] = (ys - top) / (bottom - top) * h
+    if not flip:
+        pixels[:, 1] = h - pixels[:, 1]
+    return pixels
+
 def ragularize_lonlat(lon, lat):
     if lon > 180.0:
         lon = 180.0
@@ -321,30 +506,90 @@ def parse_quadkey(quadkey):
     ''' Returna a Tile from a given Quadkey '''
     if len(quadkey) == 0:
         return Tile(0, 0, 0)
-    x, y = 0, 0
-    for i, digit in enumerate(reversed(quadkey)):
-        mask = 1 << i
-        if digit == "1":
-            x = x | mask
-        elif digit == "2":
-            y= y | mask
-        elif digit == "3":
-            x = x | mask
-            y = y | mask
-        elif digit != "0":
+    for digit in quadkey:
+        if digit not in QUADKEY_DIGITS:
             raise ParseError(f"Unexpected quadkey digit: {digit}")
-    return Tile(i + 1, x, y)
+    x, y = unmorton(int(quadkey, 4))
+    return Tile(len(quadkey), x, y)
+
+def parse_tile_id(tile_id):
+    ''' Returns a Tile from a given tile id (see Tile.tile_id) '''
+    z = tile_id & ZOOM_MASK
+    if z > MAX_ID_ZOOM:
+        raise ParseError(f"Unexpected tile id zoom: {z}")
+    x, y = unmorton(tile_id >> (2 * (MAX_ID_ZOOM - z) + ZOOM_BITS))
+    return Tile(z, x, y)
+
+def parent_id(tile_id, zoom):
+    ''' Gets the id of the ancestor at given zoom of a tile id (zoom must not be greater than its own) '''
+    if not 0 <= zoom <= tile_id & ZOOM_MASK:
+        raise ParseError(f"Parent zoom(requested: {zoom}) must be less than current tile zoom({tile_id & ZOOM_MASK})")
+    shift = 2 * (MAX_ID_ZOOM - zoom) + ZOOM_BITS
+    return tile_id >> shift << shift | zoom
+
+def is_ancestor(ancestor_id, tile_id):
+    ''' Tells if a tile id is an ancestor of another (or the same tile) '''
+    zoom = ancestor_id & ZOOM_MASK
+    return zoom <= tile_id & ZOOM_MASK and parent_id(tile_id, zoom) == ancestor_id
+
+def descendant_range(tile_id):
+    '''
+    Gets the ids of the tile and of all its descendants, at any zoom, as a range (start, stop) of integers
+
+    A tile id t is a descendant if start <= t < stop: in SQL, "BETWEEN start AND stop - 1"
+    '''
+    shift = 2 * (MAX_ID_ZOOM - (tile_id & ZOOM_MASK)) + ZOOM_BITS
+    start = tile_id & ~ZOOM_MASK
+    return (start, start + (1 << shift))
+
+# Quadkey digit of the Morton code 2 bits (y, x)
+QUADKEY_DIGITS = "0123"
+ZOOM_MASK = (1 << ZOOM_BITS) - 1
+
+def morton(x, y):
+    ''' Gets the Morton code of (x, y): their bits interleaved, x in the even bits, y in the odd ones '''
+    return _spread_bits(x) | _spread_bits(y) << 1
+
+def unmorton(code):
+    ''' Gets (x, y) from their Morton code '''
+    return _compact_bits(code), _compact_bits(code >> 1)
+
+def _spread_bits(v):
+    # 32 bits to the even bits of 64: abcd -> 0a0b0c0d
+    v &= 0xFFFFFFFF
+    v = (v | v << 16) & 0x0000FFFF0000FFFF
+    v = (v | v << 8) & 0x00FF00FF00FF00FF
+    v = (v | v << 4) & 0x0F0F0F0F0F0F0F0F
+    v = (v | v << 2) & 0x3333333333333333
+    return (v | v << 1) & 0x5555555555555555
+
+def _compact_bits(v):
+    # The even bits of 64 to 32 bits: 0a0b0c0d -> abcd
+    v &= 0x5555555555555555
+    v = (v | v >> 1) & 0x3333333333333333
+    v = (v | v >> 2) & 0x0F0F0F0F0F0F0F0F
+    v = (v | v >> 4) & 0x00FF00FF00FF00FF
+    v = (v | v >> 8) & 0x0000FFFF0000FFFF
+    return (v | v >> 16) & 0xFFFFFFFF
 
 def tileset2bbox(tileset):
-    ''' Gets the Bbox including the whole tileset '''
+    ''' Gets the Bbox including the whole tileset (all the tiles at the same zoom) '''
     # Constant. Useful to avoid limit cases
     DELTA = 1e-11
-    bbox = []
-    coord_list = [t.to_bbox().to_tuple() for t in tileset]
-    for i in range(0, 4):
-        res = sorted(coord_list, key=lambda x: x[i])
-        bbox.append((res[0][i], res[-1][i]))
-    return Bbox(bbox[0][0] + DELTA, bbox[1][1] - DELTA, bbox[2][1] - DELTA, bbox[3][0] + DELTA)
+    if isinstance(tileset, TileRange):
+        # The bounds of the range, without building its tiles (all the columns, if straddling the antimeridian)
+        zoom = tileset.z
+        wrapped = tileset.x1 > tileset.x2
+        x1, x2 = (0, 2**zoom - 1) if wrapped else (tileset.x1, tileset.x2)
+        y1, y2 = tileset.y1, tileset.y2
+    else:
+        zoom = tileset[0].z
+        xx = [t.x for t in tileset]
+        yy = [t.y for t in tileset]
+        x1, x2, y1, y2 = min(xx), max(xx), min(yy), max(yy)
+    ul = Tile(zoom, x1, y1).longlat(center=False, lr=False)
+    lr = Tile(zoom, x2, y2).longlat(center=False, lr=True)
+    return Bbox(ul.lon + DELTA, ul.lat - DELTA, lr.lon - DELTA, lr.lat + DELTA)
 
 def feature2bbox(feat):
     '''
@@ -359,19 +604,115 @@ def feature2bbox(feat):
 
 def point_in_poly(lonlat: LonLat, polygon)-> bool:
     '''
-    Determine if the point is contained in the polygon.
+    Determine if the point is contained in the polygon (GeoJSON Polygon or MultiPolygon, holes excluded).
 
+    To test many points against the same polygon, prepare it once (see PreparedPolygon).
     Check: https://en.wikipedia.org/wiki/Even%E2%80%93odd_rule
     '''
-    coord_list = list(geojson.utils.coords(polygon))
-    num = len(coord_list)
-    i = 0
-    j = num - 1
     c = False
-    for i in range(num):
-        if ((coord_list[i][1] > lonlat.lat) != (coord_list[j][1] > lonlat.lat)) and \
-            (lonlat.lon < coord_list[i][0] + (coord_list[j][0] - coord_list[i][0]) * 
-                (lonlat.lat - coord_list[i][1]) / (coord_list[j][1] - coord_list[i][1])):
-            c = not c
-        j = i
+    for ring in _ring_coords(polygon):
+        j = len(ring) - 1
+        for i in range(len(ring)):
+            if ((ring[i][1] > lonlat.lat) != (ring[j][1] > lonlat.lat)) and \
+                (lonlat.lon < ring[i][0] + (ring[j][0] - ring[i][0]) * 
+                    (lonlat.lat - ring[i][1]) / (ring[j][1] - ring[i][1])):
+                c = not c
+            j = i
     return c
+
+class PreparedPolygon:
+    '''
+    A GeoJSON Polygon or MultiPolygon, prepared to test the containment of many points
+
+    The edges of all its rings are indexed by horizontal bands of latitude, so that a point is tested
+    (with the even-odd rule, that excludes the holes) only against the edges of its band.
+    Points outside its bbox are excluded before any test.
+    '''
+    # Points tested at once: the pairs (point, edge of its band) are all in memory
+    CHUNK = 4096
+
+    def __init__(self, polygon, bands=None):
+        '''
+        polygon: GeoJSON Polygon or MultiPolygon, as geometry or Feature
+        bands: number of bands of the edge index (default: half the number of edges, so that a band has a few edges)
+        '''
+        self.rings = _polygon_rings(polygon)
+        if len(self.rings) == 0:
+            raise GeoError("Empty polygon")
+        points = np.concatenate(self.rings)
+        west, south = points.min(axis=0)
+        east, north = points.max(axis=0)
+        self.bbox = Bbox(float(west), float(north), float(east), float(south))
+
+        # Edges (x1, y1, x2, y2) of all the rings; horizontal ones are never crossed
+        edges = np.concatenate([np.hstack((ring[:-1], ring[1:])) for ring in self.rings])
+        self.edges = edges[edges[:, 1] != edges[:, 3]]
+
+        # Bands of latitude, and the edges overlapping every band (sorted by band, with offsets)
+        self.bands = bands if bands is not None else max(1, len(self.edges) // 2)
+        self.band_height = (north - south) / self.bands or 1.0
+        low = self._band(np.minimum(self.edges[:, 1], self.edges[:, 3]))
+        high = self._band(np.maximum(self.edges[:, 1], self.edges[:, 3]))
+        counts = high - low + 1
+        edge = np.repeat(np.arange(len(self.edges)), counts)
+        band = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + low[edge]
+        order = np.argsort(band, kind="stable")
+        self.band_edges = edge[order]
+        self.band_offsets = np.searchsorted(band[order], np.arange(self.bands + 1))
+
+    def _band(self, lats):
+        return np.clip(((lats - self.bbox.south) // self.band_height).astype(int), 0, self.bands - 1)
+
+    def contains(self, lonlat: LonLat)-> bool:
+        ''' Determine if the point is contained in the polygon '''
+        return bool(self.contains_points([(lonlat.lon, lonlat.lat)])[0])
+
+    def contains_points(self, coords):
+        '''
+        Determine which of N (lon, lat) points are contained in the polygon
+
+        Returns an (N,) bool array
+        '''
+        coords = np.asarray(coords, dtype=float).reshape(-1, 2)
+        inside = np.zeros(len(coords), dtype=bool)
+        b = self.bbox
+        candidates = np.flatnonzero(
+            (coords[:, 0] >= b.west) & (coords[:, 0] <= b.east) & (coords[:, 1] >= b.south) & (coords[:, 1] <= b.north))
+        for i in range(0, len(candidates), self.CHUNK):
+            chunk = candidates[i:i + self.CHUNK]
+            inside[chunk] = self._crossings(coords[chunk]) % 2 == 1
+        return inside
+
+    def _crossings(self, coords):
+        ''' Counts the edges crossed by the rays going east from the points (all inside the bbox) '''
+        band = self._band(coords[:, 1])
+        starts = self.band_offsets[band]
+        counts = self.band_offsets[band + 1] - starts
+        point = np.repeat(np.arange(len(coords)), counts)
+        edge = self.band_edges[np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts) + starts[point]]
+        x, y = coords[point, 0], coords[point, 1]
+        x1, y1, x2, y2 = self.edges[edge].T
+        crossed = ((y1 > y) != (y2 > y)) & (x < x1 + (x2 - x1) * (y - y1) / (y2 - y1))
+        return np.bincount(point[crossed], minlength=len(coords))
+
+def _ring_coords(polygon):
+    ''' Gets the rings (lists of coordinates) of a GeoJSON Polygon or MultiPolygon, as geometry or Feature '''
+    if polygon.get("type") == "Feature":
+        polygon = polygon["geometry"]
+    if polygon["type"] == "Polygon":
+        return list(polygon["coordinates"])
+    if polygon["type"] == "MultiPolygon":
+        return [ring for rings in polygon["coordinates"] for ring in rings]
+    raise GeoError(f"Not a Polygon or MultiPolygon: {polygon['type']}")
+
+def _polygon_rings(polygon):
+    ''' Gets the rings of a GeoJSON Polygon or MultiPolygon with at least 3 vertices, as closed (N, 2) arrays '''
+    rings = []
+    for ring in _ring_coords(polygon):
+        if len(ring) < 3:
+            continue
+        ring = np.array([c[:2] for c in ring], dtype=float)
+        if not np.array_equal(ring[0], ring[-1]):
+            ring = np.vstack((ring, ring[:1]))
+        rings.append(ring)
+    return rings
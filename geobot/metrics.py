@@ -0,0 +1,300 @@
+'''
+Metrics: durations of the stages of the requests, counters and histograms, exported in the Prometheus text format
+
+Every process (e.g., every gunicorn worker) counts on its own, and writes a snapshot of its metrics
+to a file named after its pid and start time; the exported metrics are the sum of all the snapshots.
+The snapshots of the processes no longer running are folded into a retained total, so that the counters
+never go down, and the directory does not grow with every worker ever started.
+'''
+import os
+import json
+import time
+import fcntl
+import bisect
+import tempfile
+import threading
+import contextvars
+from pathlib import Path
+from contextlib import contextmanager
+
+# Buckets of the durations, in seconds
+TIME_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Metric:
+    ''' A metric, with a value for every combination of its labels '''
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def snapshot(self):
+        ''' Gets the metric as a dict ready for JSON '''
+        with self._lock:
+            values = [[list(k), v if not isinstance(v, list) else list(v)] for k, v in self._values.items()]
+        return {"kind": self.kind, "help": self.help, "labels": list(self.labels), "values": values}
+
+class Counter(Metric):
+    ''' A count that only goes up '''
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+class Histogram(Metric):
+    ''' Observed values, counted in buckets (stored as [count per bucket..., count above the last, sum]) '''
+    kind = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.get(key)
+            if values is None:
+                values = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            values[bisect.bisect_left(self.buckets, value)] += 1
+            values[-1] += value
+
+    def snapshot(self):
+        snapshot = super().snapshot()
+        snapshot["buckets"] = list(self.buckets)
+        return snapshot
+
+
+class Registry:
+    ''' The metrics of the process '''
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+        self._flusher = None
+        # (pid, start time in ms) of the process, naming its snapshot
+        self._ident = None
+
+    def counter(self, name, help, labels=()):
+        ''' Gets the Counter with the name, created if missing '''
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=TIME_BUCKETS):
+        ''' Gets the Histogram with the name, created if missing '''
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def _get(self, cls, name, *args):
+        with self._lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, *args)
+            return self.metrics[name]
+
+    def snapshot(self):
+        ''' Gets all the metrics as a dict ready for JSON '''
+        return {name: metric.snapshot() for name, metric in list(self.metrics.items())}
+
+    def write(self, path):
+        ''' Writes the snapshot of the process to the directory path (atomically, as {pid}-{start}.json) '''
+        if self._ident is None or self._ident[0] != os.getpid():
+            # A new process (also a forked one): a pid may be reused, the pair with the start time is not
+            self._ident = (os.getpid(), int(time.time() * 1000))
+        Path(path).mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.snapshot(), f)
+            os.replace(tmp_path, f"{path}/{self._ident[0]}-{self._ident[1]}.json")
+        except OSError as e:
+            print(e)
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+    def autoflush(self, path, interval=1.0):
+        '''
+        Writes the snapshot of the process to the directory path every interval seconds, in a daemon thread
+
+        Call it in every process (e.g., when handling a request): the thread is started once per process,
+        so that requests do not pay for the writes.
+        '''
+        with self._lock:
+            if self._flusher is not None and self._flusher[0] == os.getpid():
+                return
+            thread = threading.Thread(target=self._flush, args=(path, interval), daemon=True)
+            self._flusher = (os.getpid(), thread)
+        thread.start()
+
+    def _flush(self, path, interval):
+        while True:
+            time.sleep(interval)
+            self.write(path)
+
+# Snapshot of the sum of the processes no longer running
+RETAINED = "retained.json"
+
+def collect(path):
+    '''
+    Gets the sum of the snapshots of all the processes, written in the directory path
+
+    The snapshots of the processes no longer running are first folded into the retained total (see retain),
+    so that the counters never go down.
+    '''
+    if not os.path.isdir(path):
+        return {}
+    retain(path)
+    merged = {}
+    for name in os.listdir(path):
+        if not name.endswith(".json"):
+            continue
+        snapshot = _load(f"{path}/{name}")
+        if snapshot is not None:
+            _merge(merged, snapshot)
+    return merged
+
+def retain(path):
+    '''
+    Folds the snapshots of the processes no longer running into the retained total, and deletes them
+
+    A process is no longer running if its pid is not, or if a process with the same pid started later.
+    '''
+    with open(f"{path}/.retained.lock", 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        started = {}
+        for name in os.listdir(path):
+            ident = _ident(name)
+            if ident is not None:
+                started.setdefault(ident[0], []).append((ident[1], name))
+        dead = [name for pid, starts in started.items()
+            for start, name in starts if start < max(starts)[0] or not _running(pid)]
+        if len(dead) == 0:
+            return
+        retained = {}
+        for name in [RETAINED] + dead:
+            snapshot = _load(f"{path}/{name}")
+            if snapshot is not None:
+                _merge(retained, snapshot)
+        # Back to the format of the snapshots
+        for metric in retained.values():
+            metric["values"] = [[list(k), v] for k, v in metric["values"].items()]
+        fd, tmp_path = tempfile.mkstemp(dir=path, prefix=".tmp-")
+        with os.fdopen(fd, 'w') as f:
+            json.dump(retained, f)
+        os.replace(tmp_path, f"{path}/{RETAINED}")
+        for name in dead:
+            try:
+                os.remove(f"{path}/{name}")
+            except OSError:
+                pass
+
+def _ident(name):
+    ''' Gets the (pid, start) of the name of a snapshot, or None if it is not one (start is 0 if not in the name) '''
+    stem, _, ext = name.partition(".")
+    pid, _, start = stem.partition("-")
+    if ext != "json" or not pid.isdigit() or not (start.isdigit() or start == ""):
+        return None
+    return int(pid), int(start or 0)
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+def _load(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _merge(merged, snapshot):
+    ''' Adds the values of a snapshot to the merged metrics '''
+    for metric_name, metric in snapshot.items():
+        target = merged.setdefault(metric_name, dict(metric, values={}))
+        for key, value in metric["values"]:
+            key = tuple(key)
+            if key not in target["values"]:
+                target["values"][key] = value
+            elif isinstance(value, list):
+                target["values"][key] = [a + b for a, b in zip(target["values"][key], value)]
+            else:
+                target["values"][key] += value
+
+def to_prometheus(merged):
+    ''' Gets the collected metrics (see collect) in the Prometheus text format '''
+    lines = []
+    for name, metric in sorted(merged.items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric["values"].items()):
+            labels = [f'{label}="{_escape(v)}"' for label, v in zip(metric["labels"], key)]
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(metric["buckets"] + ["+Inf"], value[:-1]):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(f"{name}_bucket{_labels(labels + [le])} {cumulative}")
+            lines.append(f"{name}_sum{_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{_labels(labels)} {cumulative}")
+    return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    return "{" + ",".join(labels) + "}" if len(labels) > 0 else ""
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# The metrics of the process
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("geobot_stage_seconds", "Duration of the stages of the requests", ("stage",))
+REQUEST_SECONDS = REGISTRY.histogram("geobot_request_seconds", "Duration of the requests", ("endpoint", "status"))
+CACHE_LOOKUPS = REGISTRY.counter("geobot_cache_lookups_total", "Lookups in the caches", ("cache", "result"))
+UPSTREAM_ERRORS = REGISTRY.counter("geobot_upstream_errors_total", "Failed requests to the upstream services", ("upstream", "reason"))
+UPSTREAM_BYTES = REGISTRY.counter("geobot_upstream_bytes_total", "Bytes fetched from the upstream services", ("upstream",))
+TILES_PER_RENDER = REGISTRY.histogram("geobot_tiles_per_render", "Tiles of every rendered image", buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+DEGRADED_TILES = REGISTRY.counter("geobot_degraded_tiles_total", "Tiles not downloaded, but replaced", ("quality",))
+
+
+# Stages of the current request
+_timings = contextvars.ContextVar("geobot_timings", default=None)
+
+def start_timings():
+    ''' Starts recording the stages of the current request (thread), and returns the list of (stage, seconds) '''
+    timings = []
+    _timings.set(timings)
+    return timings
+
+@contextmanager
+def stage(name):
+    '''
+    Times the stage of a request, in a with block
+
+    The duration is observed in STAGE_SECONDS, and recorded in the timings of the request, if started.
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - start
+        STAGE_SECONDS.observe(duration, stage=name)
+        timings = _timings.get()
+        if timings is not None:
+            timings.append((name, duration))
+
+def server_timing(timings):
+    ''' Gets the value of the Server-Timing header of the timings of a request (durations in ms) '''
+    return ", ".join(f"{name};dur={duration * 1000:.1f}" for name, duration in timings)
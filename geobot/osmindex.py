@@ -0,0 +1,279 @@
+'''
+Offline backend for the Points of Interest: an OSM extract ingested once into a spatial index on disk
+
+The index is a SQLite database: every tag of every tagged element is a row per grid cell
+(a tile at a fixed zoom) the bounds of the element overlap, indexed by key, value and cell, so that
+a tag query inside a bbox reads only the cells overlapped by the bbox.
+
+Ingest an extract with:
+
+    python -m geobot.osmindex extract.osm index.db
+'''
+import sys
+import json
+import sqlite3
+import overpy
+import xml.etree.ElementTree as ET
+from dataclasses import dataclass
+from typing import List
+from .geo import Bbox, LonLat, ParseError
+from .overpass import AMENITY_LIST, Result, to_overpy
+
+# Zoom of the tiles used as grid cells
+GRID_ZOOM = 12
+# Version of the layout of the database (an index of another version must be ingested again)
+INDEX_VERSION = 2
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS elements (
+    kind TEXT, id INTEGER, lat REAL, lon REAL, tags TEXT, members TEXT, geometry TEXT,
+    PRIMARY KEY (kind, id)
+);
+CREATE TABLE IF NOT EXISTS tags (
+    kind TEXT, id INTEGER, k TEXT, v TEXT, cell INTEGER, west REAL, south REAL, east REAL, north REAL,
+    PRIMARY KEY (kind, id, k, cell)
+);
+CREATE INDEX IF NOT EXISTS tags_kv_cell ON tags (k, v, kind, cell);
+'''
+
+def grid_cell(lon, lat, zoom=GRID_ZOOM):
+    ''' Gets the grid cell of a point, as x * 2^zoom + y of its tile '''
+    tile = LonLat(lon, lat).tile(zoom)
+    return tile.x * 2**zoom + tile.y
+
+def grid_cells(bounds: Bbox, zoom=GRID_ZOOM):
+    ''' Gets the grid cells overlapped by the bounds (see grid_cell) '''
+    n = 2**zoom
+    return [x * n + y for x1, x2, y1, y2 in bounds.tile_ranges(zoom) for x in range(x1, x2 + 1) for y in range(y1, y2 + 1)]
+
+
+class OsmIndex:
+    '''
+    Spatial index of an OSM extract, stored in a SQLite database
+    '''
+    def __init__(self, path, zoom=GRID_ZOOM):
+        '''
+        path: the database file (created if missing)
+        zoom: zoom of the grid cells (must be the same used to ingest the extract)
+        '''
+        self.path = path
+        self.zoom = zoom
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        version = self.db.execute("PRAGMA user_version").fetchone()[0]
+        tables = self.db.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0]
+        if tables > 0 and version != INDEX_VERSION:
+            raise ParseError(f"{path} is an index of another version: ingest the extract again into a new file")
+        self.db.executescript(SCHEMA)
+        self.db.execute(f"PRAGMA user_version = {INDEX_VERSION}")
+
+    def ingest(self, extract):
+        '''
+        Ingests an OSM extract, either XML (.osm) or PBF (.pbf, needs the osmium package)
+
+        Only the tagged elements are indexed; the coordinates of the untagged nodes
+        are used for the geometry, the center and the bounds of ways and relations.
+        Ingesting is idempotent: the elements already in the index are replaced.
+        '''
+        if extract.endswith(".pbf"):
+            elements = _read_pbf(extract)
+        else:
+            elements = _read_xml(extract)
+        db = self.db
+        db.execute("CREATE TEMP TABLE coords (id INTEGER PRIMARY KEY, lat REAL, lon REAL)")
+        db.execute("CREATE TEMP TABLE centers (kind TEXT, id INTEGER, lat REAL, lon REAL, west REAL, south REAL, east REAL, north REAL, PRIMARY KEY (kind, id))")
+        batch = []
+        for kind, osm_id, tags, data in elements:
+            if kind == "node":
+                lat, lon = data
+                batch.append((osm_id, lat, lon))
+                if len(batch) >= 10000:
+                    db.executemany("INSERT OR REPLACE INTO coords VALUES (?, ?, ?)", batch)
+                    batch = []
+                if len(tags) > 0:
+                    self._add("node", osm_id, lat, lon, tags, (lon, lat, lon, lat))
+                continue
+            if len(batch) > 0:
+                db.executemany("INSERT OR REPLACE INTO coords VALUES (?, ?, ?)", batch)
+                batch = []
+            if kind == "way":
+                found = self._lookup("SELECT id, lon, lat FROM coords WHERE id IN ({})", data)
+                geometry = [found[ref] for ref in data if ref in found]
+                if len(geometry) == 0:
+                    continue
+                lon = sum(c[0] for c in geometry) / len(geometry)
+                lat = sum(c[1] for c in geometry) / len(geometry)
+                bounds = _bounds(geometry)
+                db.execute("INSERT OR REPLACE INTO centers VALUES ('way', ?, ?, ?, ?, ?, ?, ?)", (osm_id, lat, lon) + bounds)
+                if len(tags) > 0:
+                    self._add("way", osm_id, lat, lon, tags, bounds, members=data, geometry=geometry)
+            elif kind == "relation" and len(tags) > 0:
+                # Centers and bounds of the members (a node is its own bounds)
+                found = {
+                    "node": self._lookup("SELECT id, lon, lat, lon, lat, lon, lat FROM coords WHERE id IN ({})",
+                        [ref for member_type, ref, _ in data if member_type == "node"]),
+                    "way": self._lookup("SELECT id, lon, lat, west, south, east, north FROM centers WHERE kind = 'way' AND id IN ({})",
+                        [ref for member_type, ref, _ in data if member_type == "way"]),
+                    "relation": {}
+                }
+                centers = [found[member_type][ref] for member_type, ref, _ in data if ref in found.get(member_type, {})]
+                if len(centers) == 0:
+                    continue
+                lon = sum(c[0] for c in centers) / len(centers)
+                lat = sum(c[1] for c in centers) / len(centers)
+                bounds = (min(c[2] for c in centers), min(c[3] for c in centers), max(c[4] for c in centers), max(c[5] for c in centers))
+                self._add("relation", osm_id, lat, lon, tags, bounds, members=data)
+        db.execute("DROP TABLE coords")
+        db.execute("DROP TABLE centers")
+        db.commit()
+
+    def _lookup(self, query, ids, chunk=500):
+        ''' Runs the query ("... WHERE id IN ({})") for the ids, a chunk at a time, as {id: rest of the row} '''
+        found = {}
+        ids = list(dict.fromkeys(ids))
+        for i in range(0, len(ids), chunk):
+            part = ids[i:i + chunk]
+            for row in self.db.execute(query.format(",".join("?" * len(part))), part):
+                found[row[0]] = row[1:]
+        return found
+
+    def _add(self, kind, osm_id, lat, lon, tags, bounds, members=None, geometry=None):
+        ''' Adds an element, its tags under every grid cell its bounds (west, south, east, north) overlap '''
+        west, south, east, north = bounds
+        cells = grid_cells(Bbox(west, north, east, south), self.zoom)
+        self.db.execute(
+            "INSERT OR REPLACE INTO elements VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (kind, osm_id, lat, lon, json.dumps(tags),
+                json.dumps(members) if members is not None else None,
+                json.dumps(geometry) if geometry is not None else None)
+        )
+        # The rows of a previous ingest may be under other tags or cells
+        self.db.execute("DELETE FROM tags WHERE kind = ? AND id = ?", (kind, osm_id))
+        self.db.executemany(
+            "INSERT OR REPLACE INTO tags VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [(kind, osm_id, k, v, cell) + bounds for k, v in tags.items() for cell in cells]
+        )
+
+    def find(self, kind, k, v, bbox: Bbox):
+        ''' Gets the ids of the elements of a kind (node, way, relation) tagged k=v overlapping the bbox '''
+        n = 2**self.zoom
+        conditions = []
+        params = [k, v, kind, bbox.north, bbox.south, bbox.east, bbox.west]
+        # Every column of the grid is a range of cells
+        for x1, x2, y1, y2 in bbox.tile_ranges(self.zoom):
+            for x in range(x1, x2 + 1):
+                conditions.append("cell BETWEEN ? AND ?")
+                params += [x * n + y1, x * n + y2]
+        rows = self.db.execute(
+            f'''SELECT DISTINCT id FROM tags WHERE k = ? AND v = ? AND kind = ?
+                AND south <= ? AND north >= ? AND west <= ? AND east >= ?
+                AND ({" OR ".join(conditions)})''',
+            params
+        )
+        return [r[0] for r in rows]
+
+    def element(self, kind, osm_id):
+        ''' Gets an element as (lat, lon, tags, members, geometry), or None '''
+        row = self.db.execute(
+            "SELECT lat, lon, tags, members, geometry FROM elements WHERE kind = ? AND id = ?", (kind, osm_id)
+        ).fetchone()
+        if row is None:
+            return None
+        lat, lon, tags, members, geometry = row
+        return (lat, lon, json.loads(tags),
+            json.loads(members) if members is not None else None,
+            json.loads(geometry) if geometry is not None else None)
+
+
+@dataclass
+class LocalQuery:
+    '''
+    Same as SimpleQuery, but answered by an OsmIndex instead of the Overpass API
+    '''
+    bbox: Bbox
+    index: OsmIndex
+
+    def __post_init__(self):
+        self.requests = []
+
+    def node_kv(self, k: str, v_list: List[str]):
+        for v in v_list:
+            self.requests.append(("node", k, v))
+
+    def way_kv(self, k: str, v_list: List[str]):
+        for v in v_list:
+            self.requests.append(("way", k, v))
+
+    def rel_kv(self, k: str, v_list: List[str]):
+        for v in v_list:
+            self.requests.append(("relation", k, v))
+
+    def add_poi(self, poi):
+        ''' Adds a Point Of Interest to the list of elements to retrieve (as node, way or relation) '''
+        if poi in AMENITY_LIST:
+            for kind in ("node", "way", "relation"):
+                self.requests.append((kind, "amenity", poi))
+
+    def execute(self):
+        ''' Gets the requested elements as Result, like SimpleQuery.execute() '''
+        result = overpy.Result()
+        seen = set()
+        for kind, k, v in self.requests:
+            for osm_id in self.index.find(kind, k, v, self.bbox):
+                if (kind, osm_id) in seen:
+                    continue
+                seen.add((kind, osm_id))
+                lat, lon, tags, members, geometry = self.index.element(kind, osm_id)
+                result.append(to_overpy(kind, osm_id, lat, lon, tags, result, geometry, members if kind == "way" else None))
+        return Result(result)
+
+
+def _bounds(coords):
+    ''' Gets the bounds of (lon, lat) coordinates, as (west, south, east, north) '''
+    lons = [c[0] for c in coords]
+    lats = [c[1] for c in coords]
+    return (min(lons), min(lats), max(lons), max(lats))
+
+def _read_xml(path):
+    ''' Yields the elements of an OSM XML file as (kind, id, tags, data) '''
+    root = None
+    for event, elem in ET.iterparse(path, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "start" or elem.tag not in ("node", "way", "relation"):
+            continue
+        tags = {t.get("k"): t.get("v") for t in elem.iter("tag")}
+        osm_id = int(elem.get("id"))
+        if elem.tag == "node":
+            data = (float(elem.get("lat")), float(elem.get("lon")))
+        elif elem.tag == "way":
+            data = [int(nd.get("ref")) for nd in elem.iter("nd")]
+        else:
+            data = [(m.get("type"), int(m.get("ref")), m.get("role")) for m in elem.iter("member")]
+        yield (elem.tag, osm_id, tags, data)
+        # The root keeps a reference to every parsed element: drop them all
+        elem.clear()
+        root.clear()
+
+PBF_TYPES = {"n": "node", "w": "way", "r": "relation"}
+
+def _read_pbf(path):
+    ''' Yields the elements of an OSM PBF file as (kind, id, tags, data) '''
+    try:
+        import osmium
+    except ImportError:
+        raise ParseError("Reading PBF extracts needs the osmium package (pip install osmium)")
+    for obj in osmium.FileProcessor(path):
+        tags = {t.k: t.v for t in obj.tags}
+        if obj.is_node():
+            yield ("node", obj.id, tags, (obj.location.lat, obj.location.lon))
+        elif obj.is_way():
+            yield ("way", obj.id, tags, [n.ref for n in obj.nodes])
+        elif obj.is_relation():
+            yield ("relation", obj.id, tags, [(PBF_TYPES[m.type], m.ref, m.role) for m in obj.members])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        print("Usage: python -m geobot.osmindex <extract.osm|extract.pbf> <index.db>")
+        sys.exit(1)
+    OsmIndex(sys.argv[2]).ingest(sys.argv[1])
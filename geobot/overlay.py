@@ -0,0 +1,200 @@
+'''
+Drawing of GeoJSON overlays on the image of a Bbox
+
+The coordinates of all the features are projected at once; the features outside the image are culled,
+lines and polygons are simplified to the resolution of the image, and the drawing is batched by style:
+polygons first, then lines, then points, whose marker (or dot) is rasterized once per style and stamped.
+'''
+import numpy as np
+from PIL import Image, ImageColor, ImageDraw
+from .geo import Bbox, project_to_pixels
+from .assets import badge_overlay
+
+# Vertices deviating less than TOLERANCE pixels from the simplified line are dropped (they cannot be seen)
+TOLERANCE = 0.5
+# Lines with fewer vertices are drawn as they are: simplifying them costs more than drawing them
+SIMPLIFY_ABOVE = 64
+# Features within MARGIN pixels of the image are still drawn (e.g., thick lines, markers anchored outside)
+MARGIN = 32
+
+DEFAULT_COLOR = (255, 0, 0)
+DEFAULT_RADIUS = 3
+DEFAULT_WIDTH = 2
+MAP_MARKER = chr(0xf3c5) # FA-MAP-MARKER-ALT
+
+def render_geojson(image: Image.Image, geodata, coords: Bbox, icons=None):
+    '''
+    Draws the features of a GeoJSON FeatureCollection on the image of the Bbox coords
+
+    Supported are Point (a marker glyph of icons if its "marker" property is set, otherwise a dot of "radius";
+    a badge centered on it, if it stands for "count" markers, see cluster),
+    LineString ("width") and Polygon ("outline" is the fill; every inner ring has the inverted color),
+    all with a "color"; the properties are read from the geometry. Malformed features are skipped.
+    icons: font of the markers (default: markers are drawn as dots)
+    '''
+    points, lines, rings, arrays = _collect(geodata)
+    if len(arrays) == 0:
+        return
+    w, h = image.size
+    pixels = project_to_pixels(np.concatenate(arrays), coords, (w, h))
+    draw = ImageDraw.Draw(image)
+
+    for (fill, outline), parts in _group(rings).items():
+        for start, end in parts:
+            ring = _visible(pixels[start:end], w, h, 1)
+            if ring is not None:
+                draw.polygon(_flat(ring), fill=fill, outline=outline)
+
+    for (color, width), parts in _group(lines).items():
+        for start, end in parts:
+            line = _visible(pixels[start:end], w, h, width)
+            if line is not None:
+                draw.line(_flat(line), fill=color, width=width, joint="curve")
+
+    for (marker, radius, color, count), indexes in _group(points).items():
+        if count is not None:
+            mask = fill = badge_overlay(_count_label(count), color)
+            dx, dy = -(mask.width // 2), -(mask.height // 2)
+        else:
+            mask, (dx, dy) = _stamp(marker if icons is not None else None, radius, icons)
+            fill = color
+        xy = np.rint(pixels[indexes]).astype(int) + (dx, dy)
+        mw, mh = mask.size
+        inside = (xy[:, 0] > -mw) & (xy[:, 0] < w) & (xy[:, 1] > -mh) & (xy[:, 1] < h)
+        for x, y in xy[inside].tolist():
+            image.paste(fill, (x, y), mask)
+
+def simplify(points, tolerance=TOLERANCE):
+    '''
+    Simplifies a line of (N, 2) pixels, keeping its ends and the vertices deviating more than tolerance
+
+    Vertices within the same tolerance-sized cell as the previous one are dropped at once,
+    then the line is simplified with the Douglas-Peucker algorithm.
+    '''
+    if len(points) < 3:
+        return points
+    cells = np.floor(points / tolerance)
+    moved = np.any(cells[1:] != cells[:-1], axis=1)
+    keep = np.concatenate(([True], moved))
+    keep[-1] = True
+    points = points[keep]
+    n = len(points)
+    if n < 3:
+        return points
+
+    # Douglas-Peucker, splitting all the segments of a level at once
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    firsts = np.array([0])
+    lasts = np.array([n - 1])
+    while len(firsts) > 0:
+        counts = lasts - firsts - 1
+        starts = np.cumsum(counts) - counts
+        segment = np.repeat(np.arange(len(firsts)), counts)
+        inner = np.arange(counts.sum()) - starts[segment] + firsts[segment] + 1
+        a = points[firsts][segment]
+        d = (points[lasts] - points[firsts])[segment]
+        v = points[inner] - a
+        # Distance from the segment (from its nearest end, if projected outside)
+        length = np.einsum('ij,ij->i', d, d)
+        t = np.clip(np.einsum('ij,ij->i', v, d) / np.where(length > 0, length, 1), 0, 1)
+        dist = np.hypot(*(v - t[:, None] * d).T)
+        farthest = np.maximum.reduceat(dist, starts)
+        # First vertex at the farthest distance, of every segment
+        at_max = np.flatnonzero(dist == farthest[segment])
+        _, first = np.unique(segment[at_max], return_index=True)
+        split = inner[at_max[first]]
+        far = farthest > tolerance
+        keep[split[far]] = True
+        firsts, lasts = np.concatenate((firsts[far], split[far])), np.concatenate((split[far], lasts[far]))
+        wide = lasts - firsts > 1
+        firsts, lasts = firsts[wide], lasts[wide]
+    return points[keep]
+
+def _collect(geodata):
+    '''
+    Gets the features of the GeoJSON, by kind, with their style
+
+    Returns points [(style, index)], lines and rings [(style, (start, end))], all indexing
+    the concatenation of the returned list of (N, 2) coordinate arrays
+    '''
+    points, lines, rings, arrays = [], [], [], []
+    size = 0
+    for f in geodata.get('features', []) if geodata is not None else []:
+        try:
+            geometry = f['geometry']
+            props = geometry.get('properties') or {}
+            color = _color(props.get('color'), DEFAULT_COLOR)
+            f_type = geometry['type']
+            if f_type == 'Point':
+                array = np.asarray(geometry['coordinates'], dtype=float)[:2].reshape(1, 2)
+                marker = props.get('marker')
+                marker = MAP_MARKER if marker is True else marker if isinstance(marker, str) else None
+                count = props.get('count')
+                count = count if isinstance(count, int) and count > 1 else None
+                points.append(((marker, max(0, round(props.get('radius', DEFAULT_RADIUS))), color, count), size))
+                parts = [array]
+            elif f_type == 'LineString':
+                array = np.asarray(geometry['coordinates'], dtype=float)[:, :2]
+                lines.append(((color, int(props.get('width', DEFAULT_WIDTH))), (size, size + len(array))))
+                parts = [array]
+            elif f_type == 'Polygon':
+                fill = props.get('outline')
+                fill = _color(fill, None) if fill is not None else None
+                parts = [np.asarray(ring, dtype=float)[:, :2] for ring in geometry['coordinates']]
+                start = size
+                for ring in parts:
+                    rings.append(((fill, color), (start, start + len(ring))))
+                    start += len(ring)
+                    # The inner rings have the inverted color, saving alpha channel if present
+                    color = tuple(255 - c for c in color[:3]) + color[3:]
+            else:
+                continue
+        except (KeyError, TypeError, ValueError, IndexError, AttributeError):
+            continue
+        arrays.extend(parts)
+        size += sum(len(a) for a in parts)
+    return points, lines, rings, arrays
+
+def _color(value, default):
+    ''' Gets a color as tuple, from a tuple, a list (JSON) or a string (e.g., "#ff0000" or "red") '''
+    if value is None:
+        return default
+    if isinstance(value, str):
+        return ImageColor.getrgb(value)
+    return tuple(int(c) for c in value)
+
+def _group(items):
+    ''' Groups (style, item) pairs by style, keeping the order of the items within each style '''
+    groups = {}
+    for style, item in items:
+        groups.setdefault(style, []).append(item)
+    return groups
+
+def _visible(points, w, h, width):
+    ''' Gets the line (or ring) of pixels simplified if long, or None if it is outside of the image (w, h) '''
+    margin = MARGIN + width
+    low = points.min(axis=0)
+    high = points.max(axis=0)
+    if high[0] < -margin or high[1] < -margin or low[0] > w + margin or low[1] > h + margin:
+        return None
+    if len(points) > SIMPLIFY_ABOVE:
+        points = simplify(points)
+    return points if len(points) > 1 else None
+
+def _count_label(count):
+    return str(count) if count < 1000 else f"{count // 1000}k"
+
+def _flat(points):
+    return [tuple(p) for p in points.tolist()]
+
+def _stamp(marker, radius, font):
+    ''' Gets the mask of the marker glyph (or of a dot of radius, if marker is None), and its offset from the point '''
+    if marker is not None:
+        left, top, right, bottom = font.getbbox(marker)
+        mask = Image.new('L', (max(1, right - left), max(1, bottom - top)))
+        ImageDraw.Draw(mask).text((-left, -top), marker, fill=255, font=font)
+        return mask, (left, top)
+    mask = Image.new('L', (2 * radius + 1, 2 * radius + 1))
+    ImageDraw.Draw(mask).ellipse((0, 0, 2 * radius, 2 * radius), fill=255)
+    return mask, (-radius, -radius)
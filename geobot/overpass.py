@@ -1,8 +1,10 @@
 import overpy
 import geojson
-from dataclasses import dataclass
+from decimal import Decimal
+from dataclasses import dataclass, field
 from typing import List
 from .geo import Bbox, LonLat
+from .singleflight import SingleFlight
 
 AMENITY_LIST=["administration","advertising","alm","animal_boarding","animal_breeding","animal_shelter",
     "architect_office","archive","arts_centre","artwork","atm","audiologist","baby_hatch","baking_oven",
@@ -32,6 +34,9 @@ AMENITY_LIST=["administration","advertising","alm","animal_boarding","animal_bre
     "spa","sport_school","stables","stage","stool","studio","surf_school","swimming_pool","table","taxi",
     "telephone","television","theatre","ticket_booth","ticket_validator"]
 
+# Keys of the closed ways that are lines, not areas (unless tagged area=yes)
+LINEAR_KEYS = ("highway", "barrier", "railway")
+
 
 @dataclass
 class Result:
@@ -47,9 +52,9 @@ class Result:
     def nodes_coords(self):
         return [LonLat(n.lon, n.lat) for n in self.result.nodes]
     def relations_coords(self):
-        return [LonLat(r.lon, r.lat) for r in self.result.relations]
+        return [LonLat(r.center_lon, r.center_lat) for r in self.result.relations if r.center_lat is not None]
     def ways_coords(self):
-        return [LonLat(w.lon, w.lat) for w in self.result.ways]
+        return [LonLat(w.center_lon, w.center_lat) for w in self.result.ways if w.center_lat is not None]
     
     def nodes_ids(self):
         return [n.id for n in self.result.nodes]
@@ -58,84 +63,147 @@ class Result:
     def ways_ids(self):
         return [w.id for w in self.result.ways]
     
-    def to_geojson(self, props=None, node_props=None):
+    def to_geojson(self, props=None, node_props=None, way_props=None):
         '''
         Gets the Result as GeoJSON 
-        
-        NOTICE: It returns only the nodes for now
+
+        Nodes are Points, ways are LineStrings (Polygons if closed, see way_geojson), out of the geometry
+        they were retrieved with (see elements_query); relations are Points at their center.
+        No element is resolved with further requests.
+        node_props: properties of the Points (nodes, relations, and ways without geometry)
+        way_props: properties of the LineStrings and Polygons
         '''
-        nodes = []
+        features = []
         for n in self.nodes_coords():
-            nodes.append(geojson.Feature(geometry=n.to_geojson(props=node_props)))
-        """
-        # TODO make polygons out of these
-        ways = [way.get_nodes(resolve_missing=True) for way in self.ways()]
-        relations = [relation.get_nodes(resolve_missing=True) for relation in self.relations()]
-
-        for w in ways:
-            nodes.append(geojson.Feature(geometry=w.to_geojson(props=node_props)))
-        for r in relations:
-            nodes.append(geojson.Feature(geometry=r.to_geojson(props=node_props)))     
-        """
-        fc = geojson.FeatureCollection(nodes)
+            features.append(geojson.Feature(geometry=n.to_geojson(props=node_props)))
+        for w in self.ways():
+            geometry = way_geojson(w, props=way_props, center_props=node_props)
+            if geometry is not None:
+                features.append(geojson.Feature(geometry=geometry))
+        for r in self.relations_coords():
+            features.append(geojson.Feature(geometry=r.to_geojson(props=node_props)))
+        fc = geojson.FeatureCollection(features)
         if props is not None:
             fc["properties"] = props
         return fc
 
-        
+def way_coords(way):
+    '''
+    Gets the (lon, lat) coordinates of a way, without further requests, or None if not known
+
+    They come from its geometry (out geom, kept by overpy in its attributes), or from its nodes, if in the result.
+    '''
+    geometry = (way.attributes or {}).get("geometry")
+    if geometry is not None:
+        return [(float(c["lon"]), float(c["lat"])) for c in geometry if c is not None]
+    try:
+        return [(float(n.lon), float(n.lat)) for n in way.get_nodes(resolve_missing=False)]
+    except overpy.exception.DataIncomplete:
+        return None
+
+def way_geojson(way, props=None, center_props=None):
+    '''
+    Gets a way as GeoJSON geometry, without further requests
+
+    Closed ways are Polygons (unless tagged area=no, or as linear features: highway, barrier, railway),
+    the others LineStrings; if its coordinates are not known, a Point at its center, or None.
+    '''
+    coords = way_coords(way)
+    if coords is None or len(coords) < 2:
+        if way.center_lat is None:
+            return None
+        return LonLat(way.center_lon, way.center_lat).to_geojson(props=center_props)
+    tags = way.tags
+    closed = len(coords) >= 4 and coords[0] == coords[-1]
+    linear = tags.get("area") == "no" or (tags.get("area") != "yes" and any(k in tags for k in LINEAR_KEYS))
+    geometry = geojson.Polygon([coords]) if closed and not linear else geojson.LineString(coords)
+    if props is not None:
+        geometry["properties"] = props
+    return geometry
+
+def to_overpy(kind, osm_id, lat, lon, tags, result, geometry=None, node_ids=None):
+    '''
+    Gets an element as overpy Node, Way or Relation of the result (lat, lon are the center of ways and relations)
+
+    geometry: the (lon, lat) coordinates of a way, kept as if retrieved with out geom (see way_coords)
+    '''
+    lat = Decimal(str(lat))
+    lon = Decimal(str(lon))
+    if kind == "node":
+        return overpy.Node(node_id=osm_id, lat=lat, lon=lon, tags=tags, attributes={}, result=result)
+    if kind == "way":
+        attributes = {} if geometry is None else {"geometry": [{"lat": c[1], "lon": c[0]} for c in geometry]}
+        return overpy.Way(way_id=osm_id, center_lat=lat, center_lon=lon, node_ids=node_ids or [], tags=tags, attributes=attributes, result=result)
+    return overpy.Relation(rel_id=osm_id, center_lat=lat, center_lon=lon, members=[], tags=tags, attributes={}, result=result)
+
+def elements_query(statements, bbox: Bbox, out='json'):
+    '''
+    Gets a query of the elements selected by the statements, all inside the bbox, answered in a single round trip
+
+    The bbox is a global setting (the statements need no bbox of their own, e.g. "way [leisure=park];").
+    Nodes and ways are output with their geometry (out geom), relations with their center only (out center),
+    so that no member needs to be resolved with further requests.
+    '''
+    osm = ",".join(str(c) for c in bbox.to_osm())
+    return f"""
+        [out:{out}][bbox:{osm}];
+        (
+        {statements}
+        )->.found;
+        (node.found; way.found;);
+        out geom;
+        rel.found;
+        out center;
+    """
 
 @dataclass
 class SimpleQuery:
     bbox: Bbox
+    url: str = field(default=None)
+    flight: SingleFlight = field(default=None, repr=False)
 
     def __post_init__(self):
-        self.api = overpy.Overpass()
+        self.api = overpy.Overpass(url=self.url)
         self.node_req = ""
         self.way_req  = ""
         self.rel_req  = ""
 
     def node_kv(self, k: str, v_list: List[str]):
-        osm = self.bbox.to_osm()
         for v in v_list:
-            self.node_req += f"node [{k}={v}] {osm};\n"
+            self.node_req += f"node [{k}={v}];\n"
     
     def way_kv(self, k: str, v_list: List[str]):
-        osm = self.bbox.to_osm()
         for v in v_list:
-            self.way_req += f"way [{k}={v}] {osm};\n"
+            self.way_req += f"way [{k}={v}];\n"
     
     def rel_kv(self, k: str, v_list: List[str]):
-        osm = self.bbox.to_osm()
         for v in v_list:
-            self.rel_req += f"rel [{k}={v}] {osm};\n"
+            self.rel_req += f"rel [{k}={v}];\n"
     
     def execute(self, out='json'):
-        query = f"""
-            [out:{out}];
-            (
-            {self.node_req}
-            {self.way_req}
-            {self.rel_req}
-            );
-            out;
-        """
-        return Result(self.api.query(query))
+        ''' Gets the requested elements as Result, with a single query (see elements_query) '''
+        query = elements_query(f"{self.node_req}{self.way_req}{self.rel_req}", self.bbox, out)
+        if self.flight is None:
+            return Result(self.api.query(query))
+        # Identical queries in flight (in this process) share the same result
+        key = ("overpass", self.url, " ".join(query.split()))
+        return Result(self.flight.do(key, lambda: self.api.query(query)))
     
     def add_poi(self, poi):
-        ''' Adds a Point Of Interest to the list of elements to retrieve '''
+        ''' Adds a Point Of Interest to the list of elements to retrieve (as node, way or relation) '''
         # TODO add other known keys
         if poi in AMENITY_LIST:
-            osm = self.bbox.to_osm()
-            self.node_req += f"node [amenity={poi}] {osm};\n"
+            self.node_req += f"nwr [amenity={poi}];\n"
 
 
 # TODO: Work-In-Progress
 @dataclass
 class BuilderQuery:
     query: str
+    url: str = field(default=None)
 
     def __post_init__(self):
-        self.api = overpy.Overpass()
+        self.api = overpy.Overpass(url=self.url)
     
     def execute(self):
         return Result(self.api.query(self.query))
@@ -0,0 +1,148 @@
+'''
+Cache of the Points of Interest retrieved from Overpass, aligned to tiles
+'''
+import json
+import overpy
+from .cache import DiskCache
+from .singleflight import SingleFlight
+from .geo import Bbox
+from .overpass import AMENITY_LIST, BuilderQuery, Result, elements_query, to_overpy, way_coords
+from .metrics import CACHE_LOOKUPS, UPSTREAM_ERRORS
+
+class PoiCache:
+    '''
+    Cache of the Points of Interest (amenities), split in tiles at a fixed zoom
+
+    Every (tile, amenity) pair is cached on its own, so that overlapping or nearby
+    requests reuse the work of the previous ones. The pairs not in the cache are
+    retrieved with a single Overpass query, nodes, ways (with their geometry) and relations (their center);
+    every element is cached in all the requested tiles it overlaps (a way may cross many of them).
+    '''
+    def __init__(self, disk: DiskCache, zoom=14, url=None, flight: SingleFlight=None):
+        '''
+        disk: DiskCache where the pairs are stored (its ttl is the validity of the POI)
+        zoom: zoom of the tiles the requests are split into
+        url: url of the Overpass API (default: the public instance)
+        flight: SingleFlight coalescing the concurrent identical queries (default: none)
+        '''
+        self.disk = disk
+        self.zoom = zoom
+        self.url = url
+        self.flight = flight
+
+    def key(self, tile, amenity):
+        ''' Gets the cache key of a (tile, amenity) pair '''
+        return ("poi-elements", tile.tile_id(), amenity)
+
+    def query(self, bbox: Bbox, poi_list):
+        '''
+        Gets the Points of Interest inside the bbox, as a Result
+
+        poi_list: list of amenities (unknown ones are ignored, see AMENITY_LIST)
+        '''
+        amenities = list(dict.fromkeys(p for p in poi_list if p in AMENITY_LIST))
+        tileset = bbox.to_tileset(self.zoom)
+        found = []
+        missing = []
+        for tile in tileset:
+            for amenity in amenities:
+                data = self.disk.get(self.key(tile, amenity))
+                CACHE_LOOKUPS.inc(cache="poi", result="hit" if data is not None else "miss")
+                if data is None:
+                    missing.append((tile, amenity))
+                else:
+                    found += json.loads(data)
+        if len(missing) > 0 and self.flight is None:
+            found += self.fetch(missing)
+        elif len(missing) > 0:
+            key = ("overpass", tuple(sorted((t.tile_id(), a) for t, a in missing)))
+            found += self.flight.do(key, lambda: self.fetch(missing), lambda: self.lookup(missing))
+
+        # Assemble and clip to the bbox
+        elements = {}
+        for kind, osm_id, lat, lon, tags, geometry in found:
+            if (kind, osm_id) in elements:
+                continue
+            if _overlaps(bbox, float(lon), float(lat), geometry):
+                elements[(kind, osm_id)] = (lat, lon, tags, geometry)
+        result = overpy.Result()
+        for (kind, osm_id), (lat, lon, tags, geometry) in elements.items():
+            result.append(to_overpy(kind, osm_id, lat, lon, tags, result, geometry))
+        return Result(result)
+
+    def lookup(self, pairs):
+        ''' Gets the cached elements of the (tile, amenity) pairs, or None if any pair is missing '''
+        elements = []
+        for tile, amenity in pairs:
+            # A recheck of the lookups of query, already counted
+            data = self.disk.get(self.key(tile, amenity), count=False)
+            if data is None:
+                return None
+            elements += json.loads(data)
+        return elements
+
+    def fetch(self, pairs):
+        '''
+        Retrieves the elements of the (tile, amenity) pairs with a single Overpass query, and caches them
+
+        The query covers the bbox of all the tiles (a global setting, see elements_query).
+        Returns the elements, as [kind, id, lat, lon, tags, geometry] lists
+        (lat, lon are the center of ways and relations; geometry are the [lon, lat] of ways, otherwise None)
+        '''
+        bounds = [tile.to_bbox() for tile, _ in pairs]
+        bbox = Bbox(min(b.west for b in bounds), max(b.north for b in bounds), max(b.east for b in bounds), min(b.south for b in bounds))
+        amenities = dict.fromkeys(amenity for _, amenity in pairs)
+        statements = "".join(f"nwr [amenity={amenity}];\n" for amenity in amenities)
+        query = BuilderQuery(elements_query(statements, bbox), url=self.url)
+        try:
+            res = query.execute()
+        except Exception as e:
+            UPSTREAM_ERRORS.inc(upstream="overpass", reason=type(e).__name__)
+            raise
+
+        cached = {(tile.x, tile.y, amenity): [] for tile, amenity in pairs}
+        tiles = {}
+        for tile, amenity in pairs:
+            tiles.setdefault(amenity, []).append(tile)
+        for element in _elements(res):
+            _, _, lat, lon, tags, geometry = element
+            amenity = tags.get("amenity")
+            ranges = _bounds(float(lon), float(lat), geometry).tile_ranges(self.zoom)
+            for tile in tiles.get(amenity, []):
+                if any(x1 <= tile.x <= x2 and y1 <= tile.y <= y2 for x1, x2, y1, y2 in ranges):
+                    cached[(tile.x, tile.y, amenity)].append(element)
+        elements = []
+        for tile, amenity in pairs:
+            tile_elements = cached[(tile.x, tile.y, amenity)]
+            self.disk.put(self.key(tile, amenity), json.dumps(tile_elements).encode())
+            elements += tile_elements
+        return elements
+
+def _elements(res: Result):
+    ''' Gets the elements of a Result as [kind, id, lat, lon, tags, geometry] lists (see PoiCache.fetch) '''
+    for n in res.nodes():
+        yield ["node", n.id, str(n.lat), str(n.lon), n.tags, None]
+    for w in res.ways():
+        coords = way_coords(w)
+        if coords is not None and len(coords) > 0:
+            lon = sum(c[0] for c in coords) / len(coords)
+            lat = sum(c[1] for c in coords) / len(coords)
+            yield ["way", w.id, str(lat), str(lon), w.tags, [list(c) for c in coords]]
+        elif w.center_lat is not None:
+            yield ["way", w.id, str(w.center_lat), str(w.center_lon), w.tags, None]
+    for r in res.relations():
+        if r.center_lat is not None:
+            yield ["relation", r.id, str(r.center_lat), str(r.center_lon), r.tags, None]
+
+def _bounds(lon, lat, geometry):
+    ''' Gets the Bbox of an element: of its geometry, or of its center only '''
+    if geometry is None:
+        return Bbox(lon, lat, lon, lat)
+    lons = [c[0] for c in geometry]
+    lats = [c[1] for c in geometry]
+    return Bbox(min(lons), max(lats), max(lons), min(lats))
+
+def _overlaps(bbox: Bbox, lon, lat, geometry):
+    ''' Whether an element (its center, or the bounds of its geometry) overlaps the bbox '''
+    bounds = _bounds(lon, lat, geometry)
+    return bounds.west <= bbox.east and bounds.east >= bbox.west and bounds.south <= bbox.north and bounds.north >= bbox.south
@@ -0,0 +1,101 @@
+'''
+Cache of the rendered images, keyed by the normalized request parameters
+'''
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from ._version import __version__
+from .cache import DiskCache
+
+def quantize(values, precision=5):
+    ''' Rounds coordinates to precision decimal digits (5 digits are about 1 meter) '''
+    return tuple(round(float(v), precision) for v in values)
+
+def render_key(kind, coords, near=None, cropped=False, geo_json=None, poi=None, cluster=None, out_size=(600, 600), img_type="png", encoding=None):
+    '''
+    Gets the key of a render, as hex digest of its normalized parameters
+
+    kind: the kind of request (e.g. "bbox", "point")
+    coords: the (already quantized) coordinates of the request
+    geo_json: GeoJSON layer, as object (not a dumped string)
+    poi: list of the requested Points of Interest
+    cluster: pixels of the cells the markers are clustered by, if any
+    encoding: the options of the encoding, as dict (see Encoding.params)
+    '''
+    params = {
+        "version": __version__,
+        "kind": kind,
+        "coords": list(coords),
+        "near": near,
+        "cropped": bool(cropped),
+        "geo_json": geo_json,
+        "poi": sorted(set(poi)) if poi is not None else None,
+        "cluster": cluster,
+        "out_size": list(out_size) if out_size is not None else None,
+        "img_type": img_type,
+        "encoding": encoding,
+    }
+    dump = json.dumps(params, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha1(dump.encode()).hexdigest()
+
+class RenderCache:
+    '''
+    Two-tier cache of the rendered images (bytes)
+
+    The first tier is an LRU in memory, private to the process;
+    the second (optional) is a DiskCache, shared by all the workers.
+    '''
+    def __init__(self, disk: DiskCache=None, max_items=128):
+        '''
+        disk: DiskCache of the second tier (default: memory only)
+        max_items: images kept in memory
+        '''
+        self.disk = disk
+        self.max_items = max_items
+        self.memory = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        ''' Gets the image stored under key, or None '''
+        with self._lock:
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return data
+        data = self.disk.get(key) if self.disk is not None else None
+        with self._lock:
+            if data is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        ''' Stores the image under key, in both tiers '''
+        self._remember(key, data)
+        if self.disk is not None:
+            self.disk.put(key, data)
+
+    def stats(self):
+        ''' Gets the counters of this process '''
+        stats = {
+            "hits": self.hits,
+            "misses": self.misses,
+            "items": len(self.memory),
+            "max_items": self.max_items,
+        }
+        if self.disk is not None:
+            stats["disk"] = self.disk.stats()
+        return stats
+
+    def _remember(self, key, data):
+        with self._lock:
+            self.memory[key] = data
+            self.memory.move_to_end(key)
+            while len(self.memory) > self.max_items:
+                self.memory.popitem(last=False)
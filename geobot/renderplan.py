@@ -0,0 +1,93 @@
+'''
+Planning of a render: which tiles to fetch, at which zoom and scale, for the requested output size
+'''
+import math
+from dataclasses import dataclass
+from .geo import Bbox, TileRange, MAX_ZOOM, lonlat_to_tile_coords, tileset2bbox
+
+# Downscaling by integer factors (reduce, or draft decoding of JPEG) is used only while the rest of the
+# downscaling is at least REDUCING_GAP times: the result is visually the same as resampling in a single pass
+REDUCING_GAP = 2.0
+
+@dataclass
+class RenderPlan:
+    '''
+    How to render a region at a given size
+
+    region: the Bbox shown by the output image
+    zoom: zoom of the tiles to fetch
+    retina: whether to fetch the retina (@2x) tiles
+    tileset: the tiles to fetch (TileRange)
+    box: (left, top, right, bottom) of the region, in pixels of the mosaic of the whole tileset
+    size: (w, h) of the output image
+    reduce: factor every tile is reduced by when decoded (a power of 2), before compositing
+    '''
+    region: Bbox
+    zoom: int
+    retina: bool
+    tileset: TileRange
+    box: tuple
+    size: tuple
+    reduce: int = 1
+
+    @property
+    def tile_size(self):
+        ''' Size of the tiles, as fetched '''
+        return 512 if self.retina else 256
+
+def plan_render(bbox: Bbox, out_size=(600, 600), visible_tiles=4, crop_bbox=False, retina=None, max_zoom=MAX_ZOOM):
+    '''
+    Plans the render of a Bbox at the requested size
+
+    The region shown is the bbox if crop_bbox, otherwise the tiles overlapped by the bbox at the zoom
+    inferred from visible_tiles (as before planning). The output fits out_size keeping the aspect of the region,
+    and the tiles are fetched at the lowest zoom that gives the output all its pixels (but never above the zoom
+    inferred from visible_tiles), so that no more tiles than needed are fetched, decoded and resized.
+
+    The scale of the tiles is chosen too: 512px (@2x) tiles only if the 256px ones, at the highest zoom allowed,
+    cannot give the output all its pixels.
+    out_size: (w, h) of the output; if None, the region at the zoom inferred from visible_tiles, at full resolution
+    retina: fetch 512px (@2x) tiles if True, 256px ones if False (default: chosen for out_size)
+    '''
+    base_zoom = bbox.infer_zoom(visible_tiles)
+    region = bbox if crop_bbox else tileset2bbox(bbox.to_tileset(base_zoom))
+
+    # Extent of the region in tiles at zoom 0 (i.e., as fraction of the world)
+    xs, ys = lonlat_to_tile_coords([region.west, region.east], [region.north, region.south], 0)
+    west, east = float(xs[0]), float(xs[1])
+    north, south = float(ys[0]), float(ys[1])
+    # Bbox keeps west <= east: a full-width region spans the whole turn (1.0), not 0
+    span_x = east - west
+    span_y = south - north
+
+    if out_size is None:
+        retina = bool(retina)
+        tile_size = 512 if retina else 256
+        zoom = base_zoom
+        size = (max(1, round(span_x * 2**zoom * tile_size)), max(1, round(span_y * 2**zoom * tile_size)))
+    else:
+        target_w, target_h = out_size
+        scale = min(target_w / span_x, target_h / span_y)
+        size = (max(1, round(span_x * scale)), max(1, round(span_y * scale)))
+        top_zoom = min(base_zoom, max_zoom)
+        if retina is None:
+            # @2x only if the 256px tiles would need a zoom above the highest allowed
+            retina = math.ceil(math.log2(scale / 256) - 1e-9) > top_zoom
+        tile_size = 512 if retina else 256
+        # Lowest zoom at which the region has at least as many pixels as the output
+        zoom = math.ceil(math.log2(scale / tile_size) - 1e-9)
+        zoom = min(max(zoom, 0), top_zoom)
+
+    tileset = region.to_tileset(zoom)
+    n = 2**zoom
+    columns = tileset.columns()
+    left = ((west * n - columns[0]) % n) * tile_size
+    top = (north * n - tileset.y1) * tile_size
+    box = (left, top, left + span_x * n * tile_size, top + span_y * n * tile_size)
+
+    # Reduce the tiles while decoding, if the rest of the downscaling stays above REDUCING_GAP
+    ratio = (box[2] - box[0]) / size[0]
+    reduce = 1
+    while reduce * 2 <= tile_size and ratio / (reduce * 2) >= REDUCING_GAP:
+        reduce *= 2
+    return RenderPlan(region, zoom, retina, tileset, box, size, reduce)
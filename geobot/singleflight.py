@@ -0,0 +1,85 @@
+'''
+Request coalescing: concurrent calls for the same key share a single upstream fetch
+'''
+import fcntl
+import hashlib
+import threading
+from pathlib import Path
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    '''
+    Coalesces concurrent calls with the same key, so that only one of them runs
+
+    Within a process, the threads calling with a key already in flight wait for it,
+    and all get its result (or its exception).
+    Across processes (e.g., the gunicorn workers), the call runs holding a lock file:
+    the other processes wait for the lock, then look the result up again with recheck
+    (typically in a shared cache) before fetching on their own.
+    '''
+    def __init__(self, lock_dir=None, stripes=256):
+        '''
+        lock_dir: directory of the lock files (default: coalesce only within the process)
+        stripes: number of lock files the keys are spread over
+        '''
+        self.lock_dir = lock_dir.rstrip("/") if lock_dir is not None else None
+        self.stripes = stripes
+        if self.lock_dir is not None:
+            Path(self.lock_dir).mkdir(parents=True, exist_ok=True)
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def do(self, key, fn, recheck=None):
+        '''
+        Gets the result of fn(), unless a call with the same key is already in flight
+
+        key: any object with a stable repr
+        fn: the fetch, called without arguments
+        recheck: called without arguments, holding the process lock, before fn;
+            if it returns something other than None, that is the result (and fn is not called).
+            Without recheck, calls are coalesced only within the process.
+        '''
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = self._run(key, fn, recheck)
+            return call.result
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def _run(self, key, fn, recheck):
+        if self.lock_dir is None or recheck is None:
+            return fn()
+        digest = hashlib.sha1(repr(key).encode()).digest()
+        stripe = int.from_bytes(digest[:4], "big") % self.stripes
+        with open(f"{self.lock_dir}/{stripe}.lock", 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                result = recheck()
+                if result is not None:
+                    return result
+                return fn()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
@@ -1,6 +1,53 @@
+import os
+import time
+import random
 import urllib3
-import shutil
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor, wait
+from urllib.parse import urlparse
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timezone
 from .temps import TempFile, TempDir
+from .geo import Tile
+from .cache import DiskCache
+from .singleflight import SingleFlight
+from .metrics import CACHE_LOOKUPS, UPSTREAM_ERRORS, UPSTREAM_BYTES
+
+# Status codes worth retrying
+RETRY_STATUS = (429, 500, 502, 503, 504)
+
+# Quality of a tile
+EXACT = "exact"
+# Cut out of a cached ancestor, and upscaled
+OVERZOOM = "overzoom"
+# Stitched from cached descendants, and downsampled
+UNDERZOOM = "underzoom"
+# Neutral placeholder
+PLACEHOLDER = "placeholder"
+
+@dataclass
+class TileResult:
+    '''
+    Outcome of a tile download
+
+    data: the bytes of the tile, None if it failed
+    status: HTTP status of the last attempt (None if no response)
+    error: description of the failure, None if it succeeded
+    attempts: number of requests made (0 if it came from the cache)
+    image: the decoded tile, for tiles not downloaded but synthesized (see tilesynth)
+    quality: EXACT for the downloaded tiles, otherwise how it was made (OVERZOOM, UNDERZOOM, PLACEHOLDER)
+    '''
+    data: bytes = field(default=None, repr=False)
+    status: int = field(default=None)
+    error: str = field(default=None)
+    attempts: int = field(default=0)
+    image: object = field(default=None, repr=False)
+    quality: str = field(default=EXACT)
+
+    @property
+    def ok(self):
+        return self.data is not None or self.image is not None
 
 class Tileget:
     '''
@@ -9,15 +56,29 @@ class Tileget:
     since it is not possibe to install C libraries and use pyCurl
     (which would be much faster), this function is an ad-hoc replacement
     for curl o wget, in order to download tiles.
+
+    It is meant to be long-lived (see get_tileget): its connections are kept alive and reused.
     '''
-    def __init__(self, tile_server_address, apikey="", keyname="access_token", chunk_size=2**16, retina_suffix='@2x'):
+    def __init__(self, tile_server_address, apikey="", keyname="access_token", chunk_size=2**16, retina_suffix='@2x', pool_size=8,
+            cache: DiskCache=None, flight: SingleFlight=None, connect_timeout=3.0, read_timeout=10.0, retries=3, backoff=0.25, max_backoff=4.0):
         '''
         Init of tileserver wget
 
         It cache the server url.
         It can also cache the apikey needed to access the resources.
+        pool_size: connections kept alive per host (it should match the concurrent fetches)
+        cache: DiskCache for the downloaded tiles (default: no cache)
+        flight: SingleFlight coalescing the concurrent downloads of the same tile (default: none)
+        connect_timeout, read_timeout: seconds allowed to connect, and between two reads
+        retries: attempts made after the first one, for network errors and RETRY_STATUS responses
+        backoff: seconds before the first retry, doubling at each retry (with jitter), up to max_backoff;
+            a Retry-After header is honored instead (if it asks for longer than max_backoff, or than the deadline, no retry)
         '''
-        self.http = urllib3.PoolManager()
+        self.http = urllib3.PoolManager(
+            maxsize=pool_size,
+            timeout=urllib3.Timeout(connect=connect_timeout, read=read_timeout),
+            retries=False
+        )
         self.tile_server_address = tile_server_address
         self.chunk_size = chunk_size
         if apikey != "":
@@ -25,32 +86,246 @@ class Tileget:
         else:
             self.encoded_key = False
         self.retina=retina_suffix
+        self.cache = cache
+        self.flight = flight
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
     
-    def get_tile(self, z, x, y, ext, save_path=None, out_file=None, retina=False):
+    def get_tile(self, z, x, y, ext, save_path=None, out_file=None, retina=False, timeout=None):
         '''
         GET function specific for a tile server
+
+        timeout: seconds allowed for the whole download, retries included (default: no limit)
         '''
         if '.' in ext:
             ext = ext.replace('.', '')
-        retina = self.retina if retina is True else ""
-        
-        url= f"{self.tile_server_address}/{z}/{x}/{y}{retina}.{ext}"
         if save_path is None:
             save_dir = TempDir()
             save_path = save_dir.path
         if out_file is None:
             save_file = TempFile(dir=save_path, ext=ext)
             out_file = save_file.path
+        data = self.get_tile_bytes(z, x, y, ext, retina, timeout)
+        if data is None:
+            return None
+        with open(out_file, 'wb') as out:
+            out.write(data)
+        return out_file
+
+    def get_tile_bytes(self, z, x, y, ext, retina=False, timeout=None):
+        '''
+        GET function specific for a tile server, keeping the tile in memory
+
+        Returns the bytes of the tile, or None on failure (see fetch_tile for the reason)
+        timeout: seconds allowed for the whole download, retries included (default: no limit)
+        '''
+        return self.fetch_tile(z, x, y, ext, retina, timeout).data
+
+    def fetch_tile(self, z, x, y, ext, retina=False, timeout=None):
+        '''
+        GET function specific for a tile server, keeping the tile in memory
+
+        Returns a TileResult
+        timeout: seconds allowed for the whole download, retries included (default: no limit)
+        '''
+        if '.' in ext:
+            ext = ext.replace('.', '')
+        retina = self.retina if retina is True else ""
+        
+        url= f"{self.tile_server_address}/{z}/{x}/{y}{retina}.{ext}"
+        key = self.key(z, x, y, retina, ext)
+        cached = self._cached(key)
+        if self.cache is not None:
+            CACHE_LOOKUPS.inc(cache="tile", result="hit" if cached is not None else "miss")
+        if cached is not None:
+            return cached
         if self.encoded_key is not False:
             url = f"{url}?{self.encoded_key}"
-        try:
-            with self.http.request('GET', url, preload_content=False) as r, open(out_file, 'wb') as out: 
-                while True:
-                    data = r.read(self.chunk_size)
-                    if not data:
-                        break
-                    out.write(data)
-            return out_file
-        except Exception as e:
-            print(e)
+        expires = None if timeout is None else time.monotonic() + timeout
+        if self.flight is None:
+            return self._download(url, key, expires)
+        # The lookup above was already counted: the recheck is not
+        recheck = (lambda: self._cached(key, count=False)) if self.cache is not None else None
+        return self.flight.do(key, lambda: self._download(url, key, expires), recheck)
+
+    def cached_tile(self, z, x, y, ext, retina=False):
+        ''' Gets the bytes of a tile only if it is in the cache (no download), otherwise None '''
+        if '.' in ext:
+            ext = ext.replace('.', '')
+        retina = self.retina if retina is True else ""
+        cached = self._cached(self.key(z, x, y, retina, ext))
+        return cached.data if cached is not None else None
+
+    def key(self, z, x, y, retina, ext):
+        ''' Gets the cache key of a tile, by its tile id (the key must not contain the apikey) '''
+        return (self.tile_server_address, Tile(z, x, y).tile_id(), retina, ext)
+
+    def _cached(self, key, count=True):
+        if self.cache is None:
             return None
+        data = self.cache.get(key, count)
+        if data is None:
+            return None
+        return TileResult(data, status=200)
+
+    def _download(self, url, key, expires=None):
+        result = TileResult()
+        while True:
+            result.attempts += 1
+            retry_after = None
+            try:
+                # Without expiry, the timeouts of the pool apply
+                options = {}
+                if expires is not None:
+                    remaining = expires - time.monotonic()
+                    if remaining <= 0:
+                        result.error = "timeout"
+                        return result
+                    options['timeout'] = urllib3.Timeout(total=remaining, connect=min(self.connect_timeout, remaining))
+                chunks = []
+                with self.http.request('GET', url, preload_content=False, **options) as r:
+                    while True:
+                        data = r.read(self.chunk_size)
+                        if not data:
+                            break
+                        chunks.append(data)
+                    result.status = r.status
+                    retry_after = r.headers.get('Retry-After')
+                if result.status == 200:
+                    result.data = b"".join(chunks)
+                    result.error = None
+                    UPSTREAM_BYTES.inc(len(result.data), upstream="tiles")
+                    if self.cache is not None:
+                        self.cache.put(key, result.data)
+                    return result
+                result.error = f"HTTP {result.status}"
+                UPSTREAM_ERRORS.inc(upstream="tiles", reason=result.status)
+                if result.status not in RETRY_STATUS:
+                    return result
+            except Exception as e:
+                result.status = None
+                result.error = f"{type(e).__name__}: {e}"
+                UPSTREAM_ERRORS.inc(upstream="tiles", reason=type(e).__name__)
+            if result.attempts > self.retries:
+                return result
+            # Exponential backoff with jitter, or what the server asks for (giving up if too long)
+            delay = min(self.max_backoff, self.backoff * 2 ** (result.attempts - 1)) * random.uniform(0.5, 1.5)
+            asked = retry_after_seconds(retry_after)
+            if asked is not None:
+                if asked > self.max_backoff:
+                    return result
+                delay = asked
+            if expires is not None and time.monotonic() + delay >= expires:
+                return result
+            time.sleep(delay)
+
+def retry_after_seconds(value):
+    ''' Gets the seconds of a Retry-After header (delay in seconds, or HTTP-date), or None if missing or malformed '''
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        date = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=timezone.utc)
+    return max(0.0, (date - datetime.now(timezone.utc)).total_seconds())
+
+
+_getters = {}
+_getters_lock = threading.Lock()
+
+def get_tileget(tile_server_address, apikey="", **kwargs):
+    '''
+    Gets the Tileget of the current process for a tile server, creating it the first time
+
+    The other arguments (see Tileget) are used only when it is created.
+    '''
+    key = (os.getpid(), tile_server_address, apikey)
+    with _getters_lock:
+        if key not in _getters:
+            _getters[key] = Tileget(tile_server_address, apikey, **kwargs)
+        return _getters[key]
+
+
+class TileFetcher:
+    '''
+    Concurrent tile downloader
+
+    Tiles are fetched by a pool of threads, with at most per_host requests
+    running at the same time against a single tile server.
+    Every tile has its own timeout, and the whole batch has a deadline:
+    tiles not arrived by then are reported as failed.
+    '''
+    def __init__(self, max_workers=8, per_host=4, tile_timeout=5.0, deadline=15.0):
+        '''
+        max_workers: size of the thread pool
+        per_host: max concurrent requests to the same host
+        tile_timeout: seconds allowed to every single tile
+        deadline: seconds allowed to the whole batch
+        '''
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tileget")
+        self.per_host = per_host
+        self.tile_timeout = tile_timeout
+        self.deadline = deadline
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def host_limit(self, getter: Tileget):
+        ''' Gets the semaphore limiting the requests to the getter's host '''
+        host = urlparse(getter.tile_server_address).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.per_host)
+            return self._hosts[host]
+
+    def fetch(self, getter: Tileget, jobs, deadline=None):
+        '''
+        Downloads a batch of tiles concurrently
+
+        jobs: list of fetch_tile() arguments, as (z, x, y, ext, retina) tuples
+        deadline: seconds allowed to the whole batch (default: the fetcher's deadline)
+
+        Returns the TileResult of every job, in the same order as jobs
+        '''
+        deadline = self.deadline if deadline is None else deadline
+        expires = time.monotonic() + deadline
+        limit = self.host_limit(getter)
+
+        def run(job):
+            with limit:
+                remaining = expires - time.monotonic()
+                if remaining <= 0:
+                    return TileResult(error="deadline")
+                return getter.fetch_tile(*job, timeout=min(self.tile_timeout, remaining))
+
+        futures = [self.executor.submit(run, job) for job in jobs]
+        wait(futures, timeout=max(0, expires - time.monotonic()))
+        results = []
+        for f in futures:
+            if f.done() and not f.cancelled() and f.exception() is None:
+                results.append(f.result())
+            elif f.done() and not f.cancelled():
+                results.append(TileResult(error=f"{type(f.exception()).__name__}: {f.exception()}"))
+            else:
+                f.cancel()
+                results.append(TileResult(error="deadline"))
+        return results
+
+
+_fetcher = None
+_fetcher_lock = threading.Lock()
+
+def default_fetcher():
+    ''' Gets the TileFetcher shared by the current process '''
+    global _fetcher
+    with _fetcher_lock:
+        if _fetcher is None:
+            _fetcher = TileFetcher()
+        return _fetcher
@@ -1,15 +1,53 @@
+import io
+import math
 from os import listdir
-from os.path import isfile, join, basename
+from os.path import isfile, join
 from PIL import Image
-from PIL import ImageDraw
-from PIL import ImageFont
 from .tiledraw import Dtile
 
 from .temps import TempDir, TempFile
-from .tileget import Tileget
-from .geo import Bbox, Tile, tileset2bbox
+from .tileget import Tileget, TileFetcher, TileResult, default_fetcher, EXACT, PLACEHOLDER
+from .tilesynth import TileSynth, PREFER
+from .cache import PixelCache
+from .geo import Bbox, Tile
+from .metrics import stage, TILES_PER_RENDER, DEGRADED_TILES
+from .encoding import Encoding
+from .renderplan import RenderPlan, REDUCING_GAP, plan_render
 
-def get_raw_bbox(bbox:Bbox, getter: Tileget, visible_tiles=4, img_type = ".png", retina=False):
+# Color of the placeholder of a missing tile
+PLACEHOLDER_COLOR = (200, 200, 200)
+
+def get_tiles(bbox:Bbox, getter: Tileget, visible_tiles=4, img_type = ".png", retina=False, fetcher: TileFetcher=None, deadline=None, synth: TileSynth=None, zoom=None):
+    '''
+    Get tiles corresponding to the bounding specified box, in memory.
+
+    Returns the tileset, and a list with the TileResult of each tile of the tileset
+
+    bbox: the target bounding box
+    getter: Tileget
+    visible_tiles: is the given tileset dimension (approx)
+    img_type: Image type as file extension (default: "png")
+    fetcher: TileFetcher used to download the tiles concurrently (default: the process one)
+    deadline: seconds allowed to download the whole tileset (default: the fetcher's deadline)
+    synth: TileSynth, used before downloading if its policy is PREFER (default: always download)
+    zoom: zoom of the tiles (default: inferred from visible_tiles)
+    '''
+    fetcher = default_fetcher() if fetcher is None else fetcher
+    ideal_zoom = bbox.infer_zoom(visible_tiles) if zoom is None else zoom
+    tileset = bbox.to_tileset(ideal_zoom)
+    results = [None] * len(tileset)
+    if synth is not None and synth.policy.mode == PREFER:
+        # The exact tiles in the cache first, then the synthesized ones: only the rest is downloaded
+        for i, tile in enumerate(tileset):
+            data = getter.cached_tile(ideal_zoom, tile.x, tile.y, img_type, retina)
+            results[i] = TileResult(data=data) if data is not None else synth.synthesize(tile, img_type, retina)
+    todo = [i for i, r in enumerate(results) if r is None]
+    jobs = [(ideal_zoom, tileset[i].x, tileset[i].y, img_type, retina) for i in todo]
+    for i, result in zip(todo, fetcher.fetch(getter, jobs, deadline)):
+        results[i] = result
+    return tileset, results
+
+def get_raw_bbox(bbox:Bbox, getter: Tileget, visible_tiles=4, img_type = ".png", retina=False, fetcher: TileFetcher=None, deadline=None, synth: TileSynth=None):
     '''
     Get tiles corresponding to the bounding specified box.
 
@@ -20,126 +58,252 @@ def get_raw_bbox(bbox:Bbox, getter: Tileget, visible_tiles=4, img_type = ".png",
     getter: Tileget
     visible_tiles: is the given tileset dimension (approx)
     img_type: Image type as file extension (default: "png")
+    fetcher: TileFetcher used to download the tiles concurrently (default: the process one)
+    deadline: seconds allowed to download the whole tileset (default: the fetcher's deadline)
+    synth: TileSynth, used before downloading if its policy is PREFER (default: always download)
     '''
     temp_dir = TempDir()
     temp_dir_files=[]
-    ideal_zoom = bbox.infer_zoom(visible_tiles)
-    tileset = bbox.to_tileset(ideal_zoom)
-    # TODO spawn threads
-    for tile in tileset:
+    tileset, results = get_tiles(bbox, getter, visible_tiles, img_type, retina, fetcher, deadline, synth)
+    # The failed tiles are synthesized or replaced by a placeholder (see degrade_tiles)
+    tiles, _ = degrade_tiles(tileset, results, synth, retina, img_type)
+    for tile, data in zip(tileset, tiles):
         file_name = f"{tile.x}-{tile.y}"
         temp_file = TempFile(name=file_name, ext=img_type, dir=temp_dir.path)
         temp_dir_files.append(temp_file)
-        result = getter.get_tile(ideal_zoom, tile.x, tile.y, img_type, temp_dir.path, temp_file.path, retina)
-        if result is False:
-            # TODO: create a blank tile (grey) or a failsafe
-            pass
+        if isinstance(data, bytes):
+            with open(temp_file.path, 'wb') as f:
+                f.write(data)
+        else:
+            data.save(temp_file.path)
     return temp_dir, temp_dir_files, tileset
 
-def tiles2image(temp_dir, img_type = "png"):
+def tiles2image(temp_dir, img_type = "png", pixel_cache: PixelCache=None, zoom=None):
     '''
     Gets a single image out of different tiles
     
     temp_dir: is a string path 
     img_type: Image type as file extension (default: "png")
+    pixel_cache: PixelCache of the decoded tiles (default: tiles are always decoded)
+    zoom: zoom of the tiles, needed only to join tiles across the antimeridian
     '''
     img_type = img_type.lstrip(".")
     
-    tiles = [f for f in listdir(temp_dir) if isfile(join(temp_dir, f))]
-    xx = []
-    yy = []
-    
-    for f in tiles:
+    files = [f for f in listdir(temp_dir) if isfile(join(temp_dir, f))]
+    tileset = []
+    tiles = []
+    for f in files:
         name, _ = f.split('.', 1)
         x, y = name.split('-', 1)
-        xx.append(x)
-        yy.append(y)
-    xx = list(dict.fromkeys(xx))
-    yy = list(dict.fromkeys(yy))
-    xx.sort(key = int) 
-    yy.sort(key = int) 
-
-    ynames = [f"{y}.{img_type}" for y in yy]
+        tileset.append(Tile(zoom, int(x), int(y)))
+        with open(join(temp_dir, f), 'rb') as tile_file:
+            tiles.append(tile_file.read())
 
     temp_file = TempFile(ext=img_type, dir=temp_dir)
-
-    swaths = []
-
-    # create swaths
-    for x in xx:
-        swaths_names = [f"{temp_dir}/{x}-{y}" for y in ynames]
-        images =  list(map(Image.open, swaths_names))
-        widths, heights = zip(*(i.size for i in images))
-        total_height = sum(heights) 
-        max_width = max(widths) # should be 256px...
-        new_im = Image.new('RGB', (max_width, total_height))
-        y_offset = 0
-        for im in images:
-            new_im.paste(im, (0, y_offset))
-            y_offset += im.size[1]
-        swaths.append(new_im)
-    
-    # create a unique image from all swath
-    widths, heights = zip(*(i.size for i in swaths))
-    total_width = sum(widths)
-    max_height = max(heights)
-    mosaic = Image.new('RGB', (total_width, max_height))
-    x_offset = 0
-    for im in swaths:
-        mosaic.paste(im, (x_offset,0))
-        x_offset += im.size[0]
+    mosaic = tiles2mosaic(tileset, tiles, pixel_cache)
     mosaic.save(temp_file.path)
     
     return temp_file
-    
 
-def draw_image(bbox: Bbox, getter: Tileget, out_size=(600, 600), geo_json=None, img_type = ".png", visible_tiles=4, watermark=None, crop_bbox=False, retina=False):
+def tiles2mosaic(tileset, tiles, pixel_cache: PixelCache=None):
     '''
-    Preferred way to create an image from a Bounding Box an optional GeoJSON Layer, and a set size
+    Gets a single image out of different tiles, in memory
 
-    out_size: (X, Y) size of the output image in pixel. Default: (600, 600)
-        If None, it is the size given by the sum of the tiles
-    getter: Tileget
-    visible_tiles: is the given tileset dimension (approx)
-    img_type: Image type as file extension (default: "png")
-    watermark: Is a Copyright text notice. Default: None
-        Please remeber to credit with a Copyright notice the tiles provider,
-        either on the image itself with this function(preferred) or somewhere else.
+    The mosaic is allocated once, and every tile is pasted at the offset given by its coordinates.
+    Missing tiles are left blank.
+
+    tileset: the tiles, as returned by Bbox.to_tileset()
+    tiles: list of the tiles, in the same order as tileset: encoded (bytes), already decoded (Image), or None if missing
+    pixel_cache: PixelCache of the decoded tiles (default: tiles are always decoded)
+    '''
+    images = [open_tile(data, pixel_cache) if isinstance(data, bytes) else data for data in tiles]
+    sizes = [i.size for i in images if i is not None]
+    if len(sizes) == 0:
+        raise ValueError("No tile to build the mosaic with")
+    # should be 256px or 512px...
+    tile_w = max(w for w, _ in sizes)
+    tile_h = max(h for _, h in sizes)
+
+    zoom = tileset[0].z if len(tileset) > 0 else None
+    columns = {x: i for i, x in enumerate(tile_columns([t.x for t in tileset], zoom))}
+    rows = {y: i for i, y in enumerate(sorted(set(t.y for t in tileset)))}
+
+    mosaic = Image.new('RGB', (len(columns) * tile_w, len(rows) * tile_h))
+    for tile, im in zip(tileset, images):
+        if im is not None:
+            mosaic.paste(im, (columns[tile.x] * tile_w, rows[tile.y] * tile_h))
+    return mosaic
+
+def tile_columns(xx, zoom=None):
+    '''
+    Orders the x coordinates of a tileset from west to east
+
+    If the zoom is known, a tileset straddling the antimeridian is ordered correctly,
+    that is, with the highest x first (e.g., 14, 15, 0, 1 at zoom 4)
+    '''
+    xx = sorted(set(xx))
+    if zoom is None or len(xx) < 2:
+        return xx
+    n = 2 ** zoom
+    # The widest gap between two consecutive columns, going around the world, lies outside the tileset
+    gaps = [((xx[(i + 1) % len(xx)] - xx[i]) % n, i) for i in range(len(xx))]
+    _, last = max(gaps)
+    first = (last + 1) % len(xx)
+    return xx[first:] + xx[:first]
+
+def degrade_tiles(tileset, results, synth: TileSynth=None, retina=False, img_type=".png", pixel_cache: PixelCache=None):
+    '''
+    Replaces the missing tiles (failed or late) so that the mosaic can be built anyway
+
+    A missing tile is synthesized from the cached tiles of the neighbouring zooms (see TileSynth),
+    if the policy of synth allows it; otherwise it is replaced by a neutral placeholder.
+
+    results: the TileResult of every tile of the tileset (replaced in place)
+    Returns the list of tiles for tiles2mosaic(), and the number of tiles that are not exact
+    '''
+    tiles = [r.data if r.data is not None else r.image for r in results]
+    missing = [i for i, data in enumerate(tiles) if data is None]
+    if len(missing) > 0:
+        # The size of the first available tile (only that one is opened)
+        sizes = (open_tile(data, pixel_cache).size if isinstance(data, bytes) else data.size for data in tiles if data is not None)
+        size = next(sizes, (512, 512) if retina else (256, 256))
+        for i in missing:
+            result = synth.synthesize(tileset[i], img_type, retina, size) if synth is not None else None
+            if result is None:
+                result = TileResult(image=Image.new('RGB', size, PLACEHOLDER_COLOR), error=results[i].error, quality=PLACEHOLDER)
+            results[i] = result
+            tiles[i] = result.image
+    return tiles, sum(1 for r in results if r.quality != EXACT)
+
+def open_tile(data, pixel_cache: PixelCache=None):
+    ''' Opens a tile image from its bytes, reusing its decoded pixels if they are in the pixel_cache '''
+    if pixel_cache is None:
+        return Image.open(io.BytesIO(data))
+    return pixel_cache.decode(data)
+
+def tiles2region(plan: RenderPlan, tiles, pixel_cache: PixelCache=None):
+    '''
+    Gets the image of the region of a render plan out of its tiles, in memory
+
+    Only the part of the mosaic inside the region is allocated (the tiles are cropped while pasted),
+    at the resolution of the tiles reduced by plan.reduce; then it is resized once to the size of the plan.
+
+    plan: RenderPlan
+    tiles: list of the tiles, in the same order as plan.tileset: encoded (bytes), already decoded (Image), or None if missing
+    pixel_cache: PixelCache of the decoded tiles (default: tiles are always decoded)
+    '''
+    tile_size = plan.tile_size // plan.reduce
+    left, top, right, bottom = (c / plan.reduce for c in plan.box)
+    x0, y0 = math.floor(left), math.floor(top)
+    canvas = Image.new('RGB', (max(1, math.ceil(right) - x0), max(1, math.ceil(bottom) - y0)))
+    tileset = plan.tileset
+    columns = {x: i for i, x in enumerate(tileset.columns())}
+    for tile, data in zip(tileset, tiles):
+        if data is None:
+            continue
+        image = decode_tile(data, tile_size, pixel_cache)
+        canvas.paste(image, (columns[tile.x] * tile_size - x0, (tile.y - tileset.y1) * tile_size - y0))
+    box = (left - x0, top - y0, right - x0, bottom - y0)
+    if canvas.size == plan.size and box == (0, 0) + plan.size:
+        return canvas
+    return canvas.resize(plan.size, Image.LANCZOS, box=box, reducing_gap=REDUCING_GAP)
+
+def decode_tile(data, size, pixel_cache: PixelCache=None):
+    '''
+    Gets a tile as image of size x size pixels
+
+    Bigger tiles are reduced: JPEG tiles not in the pixel_cache are decoded already reduced (draft mode).
+    data: the tile, encoded (bytes) or already decoded (Image)
+    '''
+    if isinstance(data, bytes) and pixel_cache is None:
+        image = Image.open(io.BytesIO(data))
+        # Only JPEG supports it: no-op for the other formats
+        image.draft('RGB', (size, size))
+    elif isinstance(data, bytes):
+        image = pixel_cache.decode(data)
+    else:
+        image = data
+    if image.size == (size, size):
+        return image
+    if image.mode not in ("RGB", "RGBA", "L"):
+        image = image.convert("RGB")
+    factor = image.width // size
+    if factor > 1 and image.size == (size * factor, size * factor):
+        return image.reduce(factor)
+    return image.resize((size, size), Image.BILINEAR)
+
+def render_image(bbox: Bbox, getter: Tileget, out_size=(600, 600), geo_json=None, img_type = ".png", visible_tiles=4, watermark=None, crop_bbox=False, retina=None, pixel_cache: PixelCache=None, deadline=None, synth: TileSynth=None):
+    '''
+    Creates an image from a Bounding Box an optional GeoJSON Layer, and a set size, all in memory
+
+    The zoom and the scale of the tiles are chosen for the output size (see plan_render):
+    the region is cropped and resized while composing the tiles, and the GeoJSON is drawn at the final size.
+
+    Returns a Dtile not backed by any file (see Dtile.to_bytes), or None on failure
+    The arguments are the same as draw_image(), plus:
+    deadline: seconds allowed to download the tiles (default: the fetcher's deadline);
+        tiles not arrived by then are replaced (see degrade_tiles), and counted in Dtile.degraded
+    synth: TileSynth of the tiles not downloaded, according to its policy (default: placeholders only)
     '''
     try:
-        # Get tiles and create a mosaic
-        dir, file_list, tileset = get_raw_bbox(bbox, getter, visible_tiles, img_type, retina=True)
-        out_file = tiles2image(dir.path, img_type)
+        # Plan the tiles for the output size, get them, and compose the region
+        plan = plan_render(bbox, out_size, visible_tiles, crop_bbox, retina)
+        with stage("fetch"):
+            tileset, results = get_tiles(plan.region, getter, img_type=img_type, retina=plan.retina, deadline=deadline, synth=synth, zoom=plan.zoom)
+        TILES_PER_RENDER.observe(len(tileset))
+        with stage("compose"):
+            tiles, degraded = degrade_tiles(tileset, results, synth, retina=plan.retina, img_type=img_type, pixel_cache=pixel_cache)
+            region = tiles2region(plan, tiles, pixel_cache)
+        for r in results:
+            if r.quality != EXACT:
+                DEGRADED_TILES.inc(quality=r.quality)
 
-        image = Dtile(out_file, tileset2bbox(tileset))
+        image = Dtile(None, plan.region, image=region)
+        image.degraded = degraded
 
         # Draw GeoJSON
         if geo_json is not None:
-            image.load_iconset_url()
-            image.load_geojson(geo_json)
-            image.render_geojson()
-
-        # Crop to Bbox
-        if crop_bbox is True:
-            image.crop_to_coords(bbox)
-
-        # Resize
-        if out_size is not None:
-            image.harmonious_resize(out_size)
-            
+            with stage("overlay"):
+                image.load_iconset_url()
+                image.load_geojson(geo_json)
+                image.render_geojson()
+
         # Copyright Watermark
         if watermark is not None:
-            image.watermark(watermark)
-
-        # Save image
-        image.save()
-
-        # Cleanup tiles
-        for f in file_list:
-            f.remove()
+            with stage("watermark"):
+                image.watermark(watermark)
 
     except Exception as e:
         print(f"Err: {e}")
         return None
     
+    return image
+
+def draw_image(bbox: Bbox, getter: Tileget, out_size=(600, 600), geo_json=None, img_type = ".png", visible_tiles=4, watermark=None, crop_bbox=False, retina=None, pixel_cache: PixelCache=None, encoding: Encoding=None):
+    '''
+    Preferred way to create an image from a Bounding Box an optional GeoJSON Layer, and a set size
+
+    Returns the TempFile of the image (inside its own TempDir), or None on failure
+    The user MUST DELETE the file and its directory after use.
+
+    out_size: (X, Y) size of the output image in pixel, fitted keeping the aspect of the region. Default: (600, 600)
+        If None, it is the size given by the sum of the tiles
+    getter: Tileget
+    retina: use the 512px (@2x) tiles if True, the 256px ones if False (default: chosen for out_size, see plan_render)
+    visible_tiles: is the given tileset dimension (approx)
+    img_type: Image type as file extension (default: "png")
+    watermark: Is a Copyright text notice. Default: None
+        Please remeber to credit with a Copyright notice the tiles provider,
+        either on the image itself with this function(preferred) or somewhere else.
+    pixel_cache: PixelCache of the decoded tiles, to skip decoding hot tiles (default: None)
+    encoding: Encoding of the image (format, quality...) (default: img_type, at the default settings)
+    '''
+    image = render_image(bbox, getter, out_size, geo_json, img_type, visible_tiles, watermark, crop_bbox, retina, pixel_cache)
+    if image is None:
+        return None
+    out_dir = TempDir()
+    out_file = TempFile(ext=img_type if encoding is None else encoding.ext, dir=out_dir.path)
+    image.tile = out_file
+    with stage("encode"):
+        image.save(encoding)
     return out_file
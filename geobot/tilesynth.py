@@ -0,0 +1,103 @@
+'''
+Synthesis of tiles out of the cached tiles of the neighbouring zooms
+'''
+import io
+from dataclasses import dataclass
+from PIL import Image
+from .geo import Tile
+from .cache import PixelCache
+from .tileget import Tileget, TileResult, OVERZOOM, UNDERZOOM
+
+# When synthesis is acceptable
+NEVER = "never"
+# only for the tiles that cannot be downloaded (failed or late)
+FALLBACK = "fallback"
+# before downloading: a warm cache serves the neighbouring zooms for free
+PREFER = "prefer"
+
+@dataclass
+class SynthPolicy:
+    '''
+    Policy for the synthesis of the tiles
+
+    mode: when synthesis is acceptable (NEVER, FALLBACK or PREFER)
+    max_overzoom: how many zooms up an ancestor can be (it gets upscaled 2^levels times)
+    max_underzoom: how many zooms down the descendants can be (4^levels tiles are needed)
+    '''
+    mode: str = FALLBACK
+    max_overzoom: int = 4
+    max_underzoom: int = 1
+
+class TileSynth:
+    '''
+    Synthesizes tiles from the cache of a Tileget, without any download
+
+    An ancestor is preferred to the descendants, since a single cached tile is needed.
+    '''
+    def __init__(self, getter: Tileget, policy: SynthPolicy=None, pixel_cache: PixelCache=None):
+        '''
+        getter: the Tileget whose cache is used
+        policy: SynthPolicy (default: fallback only)
+        pixel_cache: PixelCache of the decoded tiles (default: tiles are always decoded)
+        '''
+        self.getter = getter
+        self.policy = SynthPolicy() if policy is None else policy
+        self.pixel_cache = pixel_cache
+
+    def synthesize(self, tile: Tile, ext, retina=False, size=None):
+        '''
+        Gets the tile synthesized out of the cache, as a TileResult with its image and quality, or None
+
+        size: (w, h) of the tile (default: 512px if retina, otherwise 256px)
+        '''
+        if self.policy.mode == NEVER:
+            return None
+        size = ((512, 512) if retina else (256, 256)) if size is None else size
+        image = self.from_ancestor(tile, ext, retina, size)
+        if image is not None:
+            return TileResult(image=image, quality=OVERZOOM)
+        image = self.from_descendants(tile, ext, retina, size)
+        if image is not None:
+            return TileResult(image=image, quality=UNDERZOOM)
+        return None
+
+    def from_ancestor(self, tile: Tile, ext, retina=False, size=(256, 256)):
+        ''' Gets the image of a tile cut out of its nearest cached ancestor, and upscaled; None if no ancestor is cached '''
+        for levels in range(1, min(self.policy.max_overzoom, tile.z) + 1):
+            parent = tile.parent(tile.z - levels)
+            data = self.getter.cached_tile(parent.z, parent.x, parent.y, ext, retina)
+            if data is None:
+                continue
+            image = self._open(data)
+            w, h = image.size
+            scale = 2 ** levels
+            dx = tile.x - parent.x * scale
+            dy = tile.y - parent.y * scale
+            box = (dx * w // scale, dy * h // scale, (dx + 1) * w // scale, (dy + 1) * h // scale)
+            return image.crop(box).resize(size, Image.BILINEAR)
+        return None
+
+    def from_descendants(self, tile: Tile, ext, retina=False, size=(256, 256)):
+        ''' Gets the image of a tile stitched from its cached descendants, and downsampled; None if any is missing '''
+        for levels in range(1, self.policy.max_underzoom + 1):
+            scale = 2 ** levels
+            images = []
+            for child in tile.children(tile.z + levels):
+                data = self.getter.cached_tile(child.z, child.x, child.y, ext, retina)
+                if data is None:
+                    break
+                images.append((child, self._open(data)))
+            else:
+                w, h = size
+                canvas = Image.new('RGB', (w * scale, h * scale))
+                for child, image in images:
+                    if image.size != size:
+                        image = image.resize(size, Image.BILINEAR)
+                    canvas.paste(image, ((child.x - tile.x * scale) * w, (child.y - tile.y * scale) * h))
+                return canvas.reduce(scale)
+        return None
+
+    def _open(self, data):
+        if self.pixel_cache is None:
+            return Image.open(io.BytesIO(data))
+        return self.pixel_cache.decode(data)